@@ -23,6 +23,16 @@ var decay_f = 0.01;
 var decay_p = 0.03;
 var decay_w = 0.05;
 
+// with --stdout the word data goes to stdout, uncompressed, instead of
+// sim-data/*-word.csv.gz, so the analysis can read it as it is produced:
+//   node simulation-1000lex.js --stdout | python v5_sg_analysis_jm_test_battery_flex2.py - -c 100
+// (everything else we print goes to stderr then). writes wait for the pipe to
+// drain, so the simulation never runs ahead of the analysis by more than the
+// pipe buffer. (a named pipe also works without --stdout: mkfifo the .csv.gz
+// path and give that path to the analysis)
+const toStdout = process.argv.includes('--stdout');
+const log = toStdout ? console.error : console.log;
+
 //var cycles = 5;   // cycles per simulation -- use this short value for prototyping
 var cycles = 100;   // cycles per simulation -- reasonable number to use is at least 80
 
@@ -60,12 +70,12 @@ for (const word of lexicon) {
     stims.push(word.phon);
 }
 
-console.log(stims);
-console.log(lexicon);
+log(stims);
+log(lexicon);
 
 stims = stims.filter(function() { return true; });    
 
-console.log(JSON.stringify(stims))
+log(JSON.stringify(stims))
 
 // if you want to replace ^ with x, uncomment lines below
 //for (i in stims){
@@ -106,7 +116,7 @@ async function simulate() {
     // Open specified output files
     // COMMENTING OUT PHONEME AND FLOW FILES TO SAVE FILESPACE 
     // SET OUTPUT DIRECTORY HERE
-    var wordFile = tracejs.openFileHandle(`./sim-data/${label}-word.csv.gz`);
+    var wordFile = toStdout ? process.stdout : tracejs.openFileHandle(`./sim-data/${label}-word.csv.gz`);
     //var featureFile = tracejs.openFileHandle(`./${label}-feature.csv.gz`);
     //var phonemeFile = tracejs.openFileHandle(`./${label}-phoneme.csv.gz`);
     //var levelsAndFlowFile = tracejs.openFileHandle(`./${label}-levels-and-flow.csv.gz`);
@@ -129,7 +139,7 @@ async function simulate() {
 		    labelreport = "_if_" + alpha_if.toString() + "_fp_" +alpha_fp.toString() + "_pw_" + alpha_pw.toString() + "_wp_" + alpha_wp.toString() + "_gf_" + gamma_f.toString() + "_gp_" + gamma_p.toString() + "_gw_" + gamma_w.toString()
 		    console.error(`\nLABEL: ${labelreport}`)
 
-		   	console.log('we will be going');
+		   	log('we will be going');
 
 		    // loop through lexicon or stimlist
 		    for (const stim of stims) {
@@ -224,7 +234,9 @@ async function simulate() {
     // End the file streams when we're done
     // featureFile.end();
     // phonemeFile.end();
-    wordFile.end();
+    if (!toStdout) {
+        wordFile.end();
+    }
     // levelsAndFlowFile.end();
 }
 
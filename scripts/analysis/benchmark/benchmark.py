@@ -0,0 +1,186 @@
+# Benchmarks for the analysis script on synthetic word-data files
+#
+# For each lexicon size (tlex 200, 1000lex 1001, lemmalex 14679 words) this writes
+# a synthetic file (synthetic.py) and times
+#   rhymes/cohorts   rhymes-cohorts.py for every word of the lexicon
+#   relations        opening the rhymes/cohorts relation table and one lookup per target
+#   processChunk     one simulation at a time from a DataFrame, with latency
+#                    percentiles and the tracemalloc peak per chunk
+#   processFile      the whole file, with per-simulation latency and the peak RSS
+#                    from its metrics file
+# Results are printed and saved as JSON; --baseline compares against an earlier
+# run so regressions show up before a long battery.
+#
+# usage: python benchmark.py -s tlex 1000lex -t 5 -o bench.json [--baseline old.json]
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+import v5_sg_analysis_jm_test_battery_flex2 as analysis  # noqa: E402
+from sim_reader import INPUT_HEADER, iterChunks, openSimFile  # noqa: E402
+from synthetic import SIZES, makeLexicon, writeFile  # noqa: E402
+
+spec = importlib.util.spec_from_file_location(
+    'rhymes_cohorts', os.path.join(HERE, '..', '..', 'rhymes-cohorts', 'tlex', 'rhymes-cohorts.py'))
+rhymes_cohorts = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(rhymes_cohorts)
+
+
+# mean, median, 95th percentile and max of a list of seconds
+def latency(seconds):
+    seconds = np.asarray(seconds)
+    return {'mean': float(seconds.mean()), 'p50': float(np.percentile(seconds, 50)),
+            'p95': float(np.percentile(seconds, 95)), 'max': float(seconds.max()), 'n': len(seconds)}
+
+
+# An Analysis object for a synthetic file, built from the script's own defaults
+def makeAnalysis(path, words, cycles, relations, outfile):
+    args = analysis.parse().parse_args([path, '-c', str(cycles), '-rel', relations, '-of', outfile])
+    a = analysis.Analysis(vars(args))
+    a.words = words
+    a.topSlices = words - 1
+    a.metricsfile = os.path.splitext(outfile)[0] + '_metrics.jsonl'
+    return a
+
+
+# Simulations of a word-data file as the DataFrames processChunk expects
+def readChunks(path):
+    with openSimFile(path) as f:
+        for offset, block in iterChunks(f):
+            yield pd.read_csv(io.BytesIO(block), names=INPUT_HEADER, skipinitialspace=True, keep_default_na=False,
+                              dtype={'Fullstring': str, 'Target': str, 'Word': str})
+
+
+def benchmarkSize(name, words, args, workdir):
+    result = {'words': words, 'cycles': args.cycles, 'combos': args.combos}
+    lexicon = makeLexicon(words, args.seed)
+    path = os.path.join(workdir, 'sim-' + name + '-word.csv.gz')
+    start = time.perf_counter()
+    simulated = writeFile(path, lexicon, args.cycles, args.combos, args.targets, args.seed)
+    result['generate_s'] = time.perf_counter() - start
+    result['simulations'] = len(simulated) * args.combos
+
+    # rhymes/cohorts of the whole lexicon, as rhymes-cohorts.py makes them
+    relDF = pd.DataFrame({'Phonology': lexicon})
+    start = time.perf_counter()
+    relDF = rhymes_cohorts.rhymesCohorts(relDF, lexicon)
+    result['rhymes_cohorts'] = {'full_s': time.perf_counter() - start}
+    relations = os.path.join(workdir, name + '_rhymes_cohorts.rel')
+    tableWords, tableRelations = analysis.relation_table.fromLists(
+        lexicon, lexicon, {rel: relDF[rel].tolist() for rel in ('cohorts', 'rhymes')})
+    analysis.relation_table.write(relations, tableWords, tableRelations)
+
+    # relation lookup: load the table, then one set of masks per target
+    start = time.perf_counter()
+    index = analysis.RelationIndex(relations)
+    loaded = time.perf_counter() - start
+    lexiconWords = np.array(lexicon, dtype=object)
+    lookups = []
+    for target in simulated:
+        start = time.perf_counter()
+        index.masks(target, lexiconWords)
+        lookups.append(time.perf_counter() - start)
+    result['relations'] = {'load_s': loaded, 'lookup': latency(lookups)}
+
+    # processChunk, one DataFrame per simulation
+    a = makeAnalysis(path, words, args.cycles, relations, os.path.join(workdir, name + '_chunk.csv'))
+    a.lengthEffects.reset()
+    chunkTimes = []
+    peaks = []
+    tracemalloc.start()
+    for dataDF in readChunks(path):
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            a.processChunk(dataDF)
+        chunkTimes.append(time.perf_counter() - start)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        del dataDF
+    tracemalloc.stop()
+    result['processChunk'] = {'latency': latency(chunkTimes), 'peak_mb': max(peaks) / 2 ** 20}
+
+    # processFile on the whole file
+    outfile = os.path.join(workdir, name + '_results.csv')
+    a = makeAnalysis(path, words, args.cycles, relations, outfile)
+    a.workers = args.workers
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        a.processFile()
+    total = time.perf_counter() - start
+    with open(a.metricsfile) as f:
+        records = [json.loads(line) for line in f]
+    result['processFile'] = {'total_s': total, 'per_sim_s': total / result['simulations'],
+                             'latency': latency([r['seconds'] for r in records]),
+                             'peak_rss_mb': max(r['rss_mb'] for r in records)}
+    return result
+
+
+# One line per measurement; with a baseline, the ratio new / old
+def report(results, baseline=None):
+    def rows(prefix, value):
+        if isinstance(value, dict):
+            for key, sub in value.items():
+                yield from rows(prefix + '.' + key if prefix else key, sub)
+        else:
+            yield prefix, value
+
+    for name, result in results.items():
+        print(name)
+        old = dict(rows('', baseline.get(name, {}))) if baseline else {}
+        for key, value in rows('', result):
+            line = '  %-36s %14.6g' % (key, value)
+            if key in old and old[key]:
+                ratio = value / old[key]
+                line += '   x%.2f' % ratio
+                if key.endswith(('_s', 'mean', 'p50', 'p95', 'max', '_mb')) and ratio > 1.2:
+                    line += '  SLOWER'
+            print(line)
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='benchmark', description='Benchmarks the analysis on synthetic files')
+    parser.add_argument('-s', '--sizes', nargs='+', default=['tlex', '1000lex'],
+                        help='lexicon sizes: ' + ', '.join(SIZES) + ' or numbers')
+    parser.add_argument('-c', '--cycles', type=int, default=100, help='cycles per simulation')
+    parser.add_argument('-cb', '--combos', type=int, default=1, help='parameter combinations')
+    parser.add_argument('-t', '--targets', type=int, default=5, help='targets per combination')
+    parser.add_argument('-j', '--workers', type=int, default=1, help='workers for processFile')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('-d', '--workdir', help='keep the synthetic files here (default: a temporary directory)')
+    parser.add_argument('-o', '--out', default='benchmark.json', help='results file')
+    parser.add_argument('-b', '--baseline', help='earlier results file to compare against')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    with contextlib.ExitStack() as stack:
+        workdir = args.workdir or stack.enter_context(tempfile.TemporaryDirectory())
+        os.makedirs(workdir, exist_ok=True)
+        results = {}
+        for size in args.sizes:
+            name = size if size in SIZES else 'lex' + size
+            results[name] = benchmarkSize(name, SIZES.get(size) or int(size), args, workdir)
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    report(results, baseline)
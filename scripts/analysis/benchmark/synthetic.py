@@ -0,0 +1,121 @@
+# Synthetic tracejs word-data files for benchmarking
+#
+# Writes sim-*-word.csv.gz files in the layout tracejs' serializeData produces
+# (see sim_reader.py): one row per word and cycle, word-major then cycle-major,
+#   Cycle, -fullstring-, Target, alpha_if, ..., gamma_w, param_combo, Word,c1,...,c33
+# with every copy value printed with four decimals. Words are drawn from lemmalex
+# (plus the silence word '-'), so the cohort and rhyme structure is realistic.
+# Activations are shaped like TRACE output: every word rests slightly below zero,
+# and one copy of each word rises along a logistic curve whose height depends on
+# how the word relates to the target (target > cohorts > rhymes > the rest).
+#
+# usage: python synthetic.py out-word.csv.gz -w 1001 -c 100 -cb 2 -t 10
+
+import argparse
+import gzip
+import os
+
+import numpy as np
+import pandas as pd
+
+LEMMALEX = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', '..', 'data',
+                        'lemmalex-with-trace-pronunciations-unique.csv')
+
+# lexicon sizes of the simulations we run
+SIZES = {'tlex': 200, '1000lex': 1001, 'lemmalex': 14679}
+
+COPIES = 33
+
+# every value tracejs can print in our range, formatted once
+VALUE_MIN = -3000
+VALUE_STRINGS = np.array(['%.4f' % (v / 10000) for v in range(VALUE_MIN, 10000)], dtype=object)
+
+
+# Picks a lexicon of `words` words: the silence word and words - 1 lemmalex words
+# input: lexicon size, random seed, lemmalex path
+# output: list of phonology strings, silence first
+def makeLexicon(words, seed=0, path=LEMMALEX):
+    phonology = pd.read_csv(path, usecols=['Phonology'], keep_default_na=False)['Phonology']
+    phonology = sorted(set(phonology) - {'-'})
+    if words - 1 > len(phonology):
+        raise ValueError('lemmalex has only ' + str(len(phonology) + 1) + ' words')
+    rng = np.random.default_rng(seed)
+    return ['-'] + sorted(rng.choice(phonology, words - 1, replace=False).tolist())
+
+
+# Activations of one simulation
+# input: lexicon, target, number of cycles, numpy Generator
+# output: (words, cycles, 33) array of values with four decimals
+def simulate(lexicon, target, cycles, rng):
+    nwords = len(lexicon)
+    height = rng.uniform(0.0, 0.15, nwords)
+    for i, word in enumerate(lexicon):
+        if word == target:
+            height[i] = rng.uniform(0.7, 0.95)
+        elif len(word) > 1 and len(target) > 1 and word[:2] == target[:2]:
+            height[i] = rng.uniform(0.3, 0.55)
+        elif len(word) > 1 and len(target) > 1 and word[1:] == target[1:]:
+            height[i] = rng.uniform(0.2, 0.4)
+
+    # each word peaks on one copy (the target on an early one) and its neighbours
+    # get part of the activation
+    peakCopy = rng.integers(0, COPIES, nwords)
+    peakCopy[lexicon.index(target)] = rng.integers(2, 6)
+    spread = np.exp(-np.abs(np.arange(COPIES)[None, :] - peakCopy[:, None]))
+    onset = rng.uniform(cycles * 0.1, cycles * 0.4, nwords)
+    curve = 1 / (1 + np.exp(-(np.arange(cycles)[None, :] - onset[:, None]) / (cycles * 0.05)))
+
+    acts = -0.05 + height[:, None, None] * curve[:, :, None] * spread[:, None, :]
+    acts += rng.normal(0, 0.01, acts.shape)
+    return np.clip(np.rint(acts * 10000), VALUE_MIN, 9999) / 10000
+
+
+# Rows of one simulation as tracejs writes them
+def serialize(lexicon, target, meta, acts):
+    cycles = acts.shape[1]
+    values = VALUE_STRINGS[(np.rint(acts * 10000).astype(np.int64) - VALUE_MIN)]
+    prefix = ', -' + target + '-, ' + target + ', ' + ', '.join(str(x) for x in meta) + ', '
+    lines = []
+    for w, word in enumerate(lexicon):
+        for c in range(cycles):
+            lines.append(str(c) + prefix + word + ',' + ','.join(values[w, c]))
+    return '\n'.join(lines) + '\n'
+
+
+# Writes a synthetic word-data file
+# input: output path, lexicon, cycles, parameter combinations, targets per
+#        combination (default: every word but silence), random seed
+# output: list of simulated targets
+def writeFile(path, lexicon, cycles=100, combos=1, targets=None, seed=0):
+    rng = np.random.default_rng(seed)
+    simulated = [word for word in lexicon if word != '-']
+    if targets is not None:
+        simulated = sorted(rng.choice(simulated, targets, replace=False).tolist())
+    with gzip.open(path, 'wt', compresslevel=1) as f:
+        for combo in range(combos):
+            # alpha_if, alpha_pw, alpha_fp, alpha_wp, gamma_f, gamma_p, gamma_w, param_combo
+            meta = [1, round(0.01 * (1 + combo % 9), 2), 0.02, 0.01, 0.02, 0.04, 0.03, combo]
+            for target in simulated:
+                f.write(serialize(lexicon, target, meta, simulate(lexicon, target, cycles, rng)))
+    return simulated
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='synthetic', description='Writes a synthetic tracejs word-data file')
+    parser.add_argument('File', metavar='file', type=str, help='output file (gzip)')
+    parser.add_argument('-w', '--words', action='store', default='1000lex',
+                        help='lexicon size: ' + ', '.join(SIZES) + ' or a number')
+    parser.add_argument('-c', '--cycles', action='store', type=int, default=100, help='cycles per simulation')
+    parser.add_argument('-cb', '--combos', action='store', type=int, default=1, help='parameter combinations')
+    parser.add_argument('-t', '--targets', action='store', type=int,
+                        help='targets per combination (default: every word)')
+    parser.add_argument('--seed', action='store', type=int, default=0, help='random seed')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+    words = SIZES.get(args.words) or int(args.words)
+    lexicon = makeLexicon(words, args.seed)
+    simulated = writeFile(args.File, lexicon, args.cycles, args.combos, args.targets, args.seed)
+    print(str(len(simulated) * args.combos) + ' simulations of ' + str(words) + ' words written to ' + args.File)
@@ -0,0 +1,150 @@
+# Online length-effects aggregator
+#
+# For every parameter combination we keep each target's activation at every 5th
+# cycle (in a preallocated targets x steps array) plus running sums per word
+# length, with Length taken from lemmalex. Simulations come grouped by
+# param_combo, so a combination is written out as soon as the next one starts:
+#   <prefix>_targets.csv   param_combo (and alpha/gamma values), Target, Length, one column per cycle
+#   <prefix>_bins.csv      param_combo (and alpha/gamma values), Length, n, mean activation per cycle
+# Memory is one combination's arrays, however many combinations the input holds.
+# mergeFiles combines the files of several shards.
+
+import os
+
+import numpy as np
+import pandas as pd
+
+META_COLUMNS = ['alpha_if', 'alpha_pw', 'alpha_fp', 'alpha_wp', "gamma_f", "gamma_p", "gamma_w", "param_combo"]
+# A simulation is identified by its parameter values and target, not by param_combo
+# alone: every run numbers its combinations from 0 (e.g. each 1000lex fifth), so
+# shards of different runs reuse the numbers. Merged shards are ordered by
+# param_combo, then by the parameter values
+SIM_KEY = META_COLUMNS + ['Target']
+SIM_ORDER = ['param_combo'] + META_COLUMNS[:-1] + ['Target']
+
+
+# Reads word lengths from a lemmalex-style csv (Phonology, Length)
+# output: dict of phonology -> length
+def loadLengths(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    lexDF = pd.read_csv(path, usecols=['Phonology', 'Length'], dtype={'Phonology': str}, keep_default_na=False)
+    return dict(zip(lexDF['Phonology'], lexDF['Length']))
+
+
+class LengthEffects:
+    def __init__(self, prefix, lengths, step=5, targets=1000):
+        self.prefix = prefix
+        self.targetsfile = prefix + '_targets.csv'
+        self.binsfile = prefix + '_bins.csv'
+        self.lengths = lengths
+        self.step = step
+        self.targets = targets
+        self.combo = None
+        # optional results_db.ResultsDB that gets a copy of every combination
+        self.db = None
+
+    # Length of a target; words missing from the lexicon count their phonemes
+    def length(self, thetarget):
+        return int(self.lengths.get(thetarget, len(thetarget)))
+
+    # Starts from scratch, removing the output of an earlier run
+    def reset(self):
+        for path in (self.targetsfile, self.binsfile):
+            if os.path.exists(path):
+                os.remove(path)
+        self.combo = None
+
+    # input: simulation metadata, target and its activation at each cycle
+    def add(self, meta, thetarget, targetData):
+        if self.combo is not None and meta['param_combo'] != self.combo['meta']['param_combo']:
+            self.finish()
+
+        curve = np.asarray(targetData[::self.step], dtype=np.float64)
+        if self.combo is None:
+            self.combo = {'meta': {h: meta[h] for h in META_COLUMNS}, 'n': 0, 'names': [],
+                          'curves': np.empty((self.targets, len(curve)), dtype=np.float32),
+                          'binN': {}, 'binSum': {}}
+        combo = self.combo
+
+        # grow the target array if the lexicon is bigger than expected
+        if combo['n'] == len(combo['curves']):
+            combo['curves'] = np.concatenate((combo['curves'], np.empty_like(combo['curves'])))
+        combo['curves'][combo['n']] = curve
+        combo['names'].append(thetarget)
+        combo['n'] = combo['n'] + 1
+
+        length = self.length(thetarget)
+        combo['binN'][length] = combo['binN'].get(length, 0) + 1
+        combo['binSum'][length] = combo['binSum'].get(length, 0) + curve
+
+    # Appends the current combination to both files and drops its arrays
+    def finish(self):
+        combo = self.combo
+        if combo is None:
+            return
+        cycles = [str(c * self.step) for c in range(combo['curves'].shape[1])]
+
+        targetsDF = pd.DataFrame(combo['curves'][:combo['n']], columns=cycles)
+        targetsDF.insert(0, 'Length', [self.length(t) for t in combo['names']])
+        targetsDF.insert(0, 'Target', combo['names'])
+        self.write(targetsDF, combo['meta'], self.targetsfile)
+
+        bins = sorted(combo['binN'])
+        binsDF = pd.DataFrame([combo['binSum'][b] / combo['binN'][b] for b in bins], columns=cycles)
+        binsDF.insert(0, 'n', [combo['binN'][b] for b in bins])
+        binsDF.insert(0, 'Length', bins)
+        self.write(binsDF, combo['meta'], self.binsfile)
+        if self.db is not None:
+            self.db.addLengthEffects(targetsDF, binsDF)
+
+        self.combo = None
+
+    def write(self, df, meta, path):
+        for col, h in enumerate(META_COLUMNS):
+            df.insert(col, h, meta[h])
+        header = not os.path.exists(path) or os.path.getsize(path) == 0
+        df.to_csv(path, mode='a', header=header, na_rep='nan', index=False)
+
+    def close(self):
+        self.finish()
+
+    # Checkpoint of the aggregator: the open combination and the size of both
+    # files (fsynced), so a resumed run can cut them back to this point
+    def state(self):
+        sizes = {}
+        for path in (self.targetsfile, self.binsfile):
+            if os.path.exists(path):
+                with open(path, 'ab') as f:
+                    os.fsync(f.fileno())
+                sizes[path] = os.path.getsize(path)
+            else:
+                sizes[path] = 0
+        return {'combo': self.combo, 'sizes': sizes}
+
+    def restore(self, state):
+        for path, size in state['sizes'].items():
+            if os.path.exists(path):
+                os.truncate(path, size)
+        self.combo = state['combo']
+
+
+# Merges the length-effects files of several shards: a simulation (SIM_KEY)
+# analyzed in more than one shard is kept once, and the per-length means are recomputed from the
+# merged targets so they stay exact
+# input: shard prefixes, output prefix
+def mergeFiles(prefixes, prefix):
+    frames = [pd.read_csv(p + '_targets.csv', keep_default_na=False, na_values=['nan'], dtype={'Target': str})
+              for p in prefixes if os.path.exists(p + '_targets.csv')]
+    if not frames:
+        return
+    targetsDF = pd.concat(frames, ignore_index=True)
+    targetsDF = targetsDF.drop_duplicates(SIM_KEY).sort_values(SIM_ORDER, kind='stable')
+    targetsDF.to_csv(prefix + '_targets.csv', na_rep='nan', index=False)
+
+    cycles = [col for col in targetsDF.columns if col not in META_COLUMNS + ['Target', 'Length']]
+    groups = targetsDF.groupby(META_COLUMNS + ['Length'], sort=False)
+    binsDF = groups[cycles].mean()
+    binsDF.insert(0, 'n', groups.size())
+    binsDF = binsDF.reset_index().sort_values(SIM_ORDER[:-1] + ['Length'], kind='stable')
+    binsDF.to_csv(prefix + '_bins.csv', na_rep='nan', index=False)
@@ -0,0 +1,75 @@
+# Per-chunk metrics for the analysis pipeline
+#
+# Stopwatch adds up the time spent in named stages of one simulation (it is
+# created where the work happens, so it also works in worker processes) and
+# carries the simulation's number of word-data rows (words x cycles), and
+# MetricsLog writes one JSON line per simulation:
+#   {"chunk": 12, "param_combo": 0, "Target": "bIt", "stages": {"read": .., "parse": .., ...},
+#    "seconds": .., "rss_mb": .., "workers_rss_mb": .., "sims_per_s": .., "rows_per_s": ..,
+#    "progress": .., "eta_s": ..}
+# progress is the fraction of the input consumed (compressed bytes for a file,
+# simulations for a store), so the ETA does not depend on a guessed lexicon or
+# combination count.
+
+import json
+import time
+from contextlib import contextmanager
+
+import psutil
+
+
+class Stopwatch:
+    def __init__(self, times=None):
+        self.times = dict(times or {})
+        self.rows = 0
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - start
+
+
+class MetricsLog:
+    def __init__(self, path, append=False):
+        self.f = open(path, 'a' if append else 'w', buffering=1)
+        self.rows = 0
+        self.process = psutil.Process()
+        self.start = time.time()
+        self.last = self.start
+        self.sims = 0
+
+    # input: simulation metadata, stage times, fraction of the input read so far,
+    #        word-data rows of the simulation
+    # output: the record written (also used for the progress line)
+    def add(self, meta, stages, progress, rows):
+        now = time.time()
+        self.sims = self.sims + 1
+        self.rows = self.rows + rows
+        elapsed = now - self.start
+        children = self.process.children(recursive=True)
+        record = {'chunk': self.sims, 'param_combo': meta['param_combo'], 'Target': meta['Target'],
+                  'stages': {name: round(t, 6) for name, t in stages.items()},
+                  'seconds': round(now - self.last, 6),
+                  'rss_mb': round(self.process.memory_info().rss / 2 ** 20, 1),
+                  'workers_rss_mb': round(sum(rss(child) for child in children) / 2 ** 20, 1),
+                  'sims_per_s': round(self.sims / elapsed, 3) if elapsed > 0 else None,
+                  'rows_per_s': round(self.rows / elapsed, 1) if elapsed > 0 else None,
+                  'progress': round(progress, 6),
+                  'eta_s': round(elapsed * (1 - progress) / progress, 1) if progress > 0 else None}
+        self.f.write(json.dumps(record) + '\n')
+        self.last = now
+        return record
+
+    def close(self):
+        self.f.close()
+
+
+# RSS of a process that may already be gone
+def rss(process):
+    try:
+        return process.memory_info().rss
+    except psutil.Error:
+        return 0
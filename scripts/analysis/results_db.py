@@ -0,0 +1,249 @@
+# SQLite results database
+#
+# With --db FILE the analysis also writes its outputs into one SQLite file, so
+# questions like "accuracy by alpha_pw x gamma_w" or "RT of 6+ phoneme words" are a
+# grouped query instead of loading every results csv into pandas:
+#   results          one row per simulation and alignment: the results columns plus
+#                    the target's Length (lemmalex); indexed on param_combo, Target and
+#                    every alpha/gamma column
+#   competitors      the --top table (alignment, rank, word, peak, peak_cycle)
+#   length_bins      mean target activation per param_combo, Length and cycle
+#   length_targets   every target's activation curve (every 5th cycle) as a float32
+#                    blob (see curve), with the cycles in the cycles column
+# Rows are keyed by (alignment,) param_combo, the alpha/gamma values and Target and
+# written with INSERT OR REPLACE, so a resumed run, a re-run or several input files
+# can go into one database, also when the files number their combinations the same
+# way (e.g. the 1000lex fifths all start at param_combo 0). Rows are committed in
+# batches and at every --resume checkpoint. Summaries are grouped by alignment
+# unless one alignment is asked for.
+# Outputs that already exist as files (shards, earlier runs) are loaded with
+# importResults / importLengthEffects, or from the command line.
+#
+# usage: python results_db.py results.sqlite -by alpha_pw gamma_w [-wh "Length >= 6"]
+#        python results_db.py results.sqlite --import results.csv results_top10.csv [-le prefix]
+
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+import pandas as pd
+
+from length_effects import META_COLUMNS, loadLengths
+
+PARAMS = ['alpha_if', 'alpha_pw', 'alpha_fp', 'alpha_wp', 'gamma_f', 'gamma_p', 'gamma_w']
+RESULTS_COLUMNS = ['alignment'] + META_COLUMNS + ['Target', 'Length', 'Recognized', 'RT', 'max', 'others_max',
+                                                  'cohort_peak_val', 'cohort_peak_time', 'rhyme_peak_val',
+                                                  'rhyme_peak_time', 'unrelated_peak_val', 'unrelated_peak_time']
+COMPETITORS_COLUMNS = ['alignment'] + META_COLUMNS + ['Target', 'rank', 'word', 'peak', 'peak_cycle']
+# user_version of the schema: 1 keyed rows by param_combo without the alpha/gamma values
+VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS results (
+    alignment TEXT NOT NULL, {params}, param_combo INTEGER NOT NULL, Target TEXT NOT NULL, Length INTEGER,
+    Recognized INTEGER, RT REAL, max REAL, others_max REAL, cohort_peak_val REAL, cohort_peak_time REAL,
+    rhyme_peak_val REAL, rhyme_peak_time REAL, unrelated_peak_val REAL, unrelated_peak_time REAL,
+    PRIMARY KEY (param_combo, {paramKey}, Target, alignment));
+CREATE INDEX IF NOT EXISTS results_target ON results (Target);
+{paramIndexes}
+CREATE TABLE IF NOT EXISTS competitors (
+    alignment TEXT NOT NULL, {params}, param_combo INTEGER NOT NULL, Target TEXT NOT NULL, rank INTEGER NOT NULL,
+    word TEXT, peak REAL, peak_cycle INTEGER,
+    PRIMARY KEY (param_combo, {paramKey}, Target, alignment, rank));
+CREATE INDEX IF NOT EXISTS competitors_word ON competitors (word);
+CREATE TABLE IF NOT EXISTS length_bins (
+    {params}, param_combo INTEGER NOT NULL, Length INTEGER NOT NULL, n INTEGER, cycle INTEGER NOT NULL,
+    activation REAL,
+    PRIMARY KEY (param_combo, {paramKey}, Length, cycle));
+CREATE TABLE IF NOT EXISTS length_targets (
+    {params}, param_combo INTEGER NOT NULL, Target TEXT NOT NULL, Length INTEGER, cycles TEXT, curve BLOB,
+    PRIMARY KEY (param_combo, {paramKey}, Target));
+'''.format(params=', '.join(p + ' REAL' for p in PARAMS), paramKey=', '.join(PARAMS),
+           paramIndexes='\n'.join('CREATE INDEX IF NOT EXISTS results_{0} ON results ({0});'.format(p)
+                                  for p in PARAMS))
+
+
+# Activation curve of a length_targets row
+def curve(blob):
+    return np.frombuffer(blob, dtype=np.float32)
+
+
+class ResultsDB:
+    def __init__(self, path, batchSize=500, interval=60.0):
+        self.path = path
+        self.batchSize = batchSize
+        self.interval = interval
+        self.con = None
+        self.pending = {}
+        self.rows = 0
+        self.lastFlush = time.time()
+
+    # The connection is opened on first use, and not pickled (the Analysis object
+    # goes to worker processes, which never write)
+    def connect(self):
+        if self.con is None:
+            con = sqlite3.connect(self.path)
+            exists = con.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'results'").fetchone()[0]
+            if exists and con.execute('PRAGMA user_version').fetchone()[0] < VERSION:
+                con.close()
+                raise ValueError(self.path + ' keys rows by param_combo only; import its outputs into a new database')
+            con.execute('PRAGMA journal_mode=WAL')
+            con.execute('PRAGMA synchronous=NORMAL')
+            con.executescript(SCHEMA)
+            con.execute('PRAGMA user_version = %d' % VERSION)
+            self.con = con
+        return self.con
+
+    def __getstate__(self):
+        return dict(self.__dict__, con=None, pending={}, rows=0)
+
+    def insert(self, table, columns, rows):
+        self.pending.setdefault((table, tuple(columns)), []).extend(rows)
+        self.rows = self.rows + len(rows)
+        if self.rows >= self.batchSize or time.time() - self.lastFlush >= self.interval:
+            self.flush()
+
+    # input: alignment label, simulation metadata, Length of the target, one results
+    #        row (Recognized ... unrelated_peak_time)
+    def addResult(self, label, meta, length, simresult):
+        self.insert('results', RESULTS_COLUMNS, [[label] + [meta[h] for h in META_COLUMNS] +
+                                                 [meta['Target'], length] + list(simresult)])
+
+    # input: alignment label, simulation metadata, competitor words, peaks and peak cycles
+    def addCompetitors(self, label, meta, words, peaks, peakCycles):
+        prefix = [label] + [meta[h] for h in META_COLUMNS] + [meta['Target']]
+        self.insert('competitors', COMPETITORS_COLUMNS,
+                    [prefix + [rank, word, float(peak), int(peakCycle)]
+                     for rank, (word, peak, peakCycle) in enumerate(zip(words, peaks, peakCycles), 1)])
+
+    # Length effects of one param_combo, as length_effects writes them
+    # input: targets and bins DataFrames (META_COLUMNS, Target / Length and n, one column per cycle)
+    def addLengthEffects(self, targetsDF, binsDF):
+        cycles = [col for col in targetsDF.columns if col not in META_COLUMNS + ['Target', 'Length']]
+        curves = targetsDF[cycles].to_numpy(dtype=np.float32)
+        self.insert('length_targets', META_COLUMNS + ['Target', 'Length', 'cycles', 'curve'],
+                    [[row[h] for h in META_COLUMNS] + [row['Target'], int(row['Length']), ' '.join(cycles),
+                                                       curves[i].tobytes()]
+                     for i, row in enumerate(targetsDF[META_COLUMNS + ['Target', 'Length']].to_dict('records'))])
+        longDF = binsDF.melt(id_vars=META_COLUMNS + ['Length', 'n'], value_vars=cycles, var_name='cycle',
+                             value_name='activation')
+        longDF['cycle'] = longDF['cycle'].astype(int)
+        columns = META_COLUMNS + ['Length', 'n', 'cycle', 'activation']
+        self.insert('length_bins', columns, longDF[columns].values.tolist())
+
+    def flush(self):
+        self.lastFlush = time.time()
+        if not self.pending:
+            return
+        con = self.connect()
+        with con:
+            for (table, columns), rows in self.pending.items():
+                con.executemany('INSERT OR REPLACE INTO {} ({}) VALUES ({})'.format(
+                    table, ', '.join(columns), ', '.join('?' * len(columns))), [toSql(row) for row in rows])
+        self.pending = {}
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+        if self.con is not None:
+            self.con.close()
+            self.con = None
+
+    # Grouped accuracy and RT: n, accuracy and mean RT of the recognized simulations
+    # input: columns to group by, optional SQL condition on the results columns,
+    #        alignment (None: every alignment, grouped by alignment first)
+    # output: DataFrame
+    def summary(self, by, where=None, alignment=None):
+        if not alignment and 'alignment' not in by:
+            by = ['alignment'] + list(by)
+        conditions = (['(' + where + ')'] if where else []) + (['alignment = ?'] if alignment else [])
+        group = ', '.join(by)
+        sql = ('SELECT {group}{comma} COUNT(*) AS n, AVG(Recognized) AS accuracy, '
+               'AVG(CASE WHEN Recognized = 1 THEN RT END) AS mean_RT FROM results{where}{groupBy}').format(
+            group=group, comma=', ' if by else '', where=' WHERE ' + ' AND '.join(conditions) if conditions else '',
+            groupBy=' GROUP BY {0} ORDER BY {0}'.format(group) if by else '')
+        return pd.read_sql_query(sql, self.connect(), params=[alignment] if alignment else [])
+
+    def query(self, sql):
+        return pd.read_sql_query(sql, self.connect())
+
+
+# numpy scalars and NaN as SQLite values
+def toSql(row):
+    values = []
+    for value in row:
+        if isinstance(value, np.generic):
+            value = value.item()
+        if isinstance(value, float) and value != value:
+            value = None
+        values.append(value)
+    return values
+
+
+# Loads a results file (csv or a parquet directory) into the database
+# input: ResultsDB, path, alignment label for files without an alignment column,
+#        dict of target -> Length
+# output: number of rows
+def importResults(db, path, label, lengths):
+    if os.path.isdir(path):
+        resultsDF = pd.read_parquet(path)
+    else:
+        resultsDF = pd.read_csv(path, keep_default_na=False, na_values=['nan'], dtype={'Target': str})
+    if 'alignment' not in resultsDF:
+        resultsDF.insert(0, 'alignment', label)
+    resultsDF['Length'] = [int(lengths.get(t, len(t))) for t in resultsDF['Target']]
+    table = 'competitors' if 'rank' in resultsDF else 'results'
+    columns = COMPETITORS_COLUMNS if table == 'competitors' else RESULTS_COLUMNS
+    db.insert(table, columns, resultsDF[columns].values.tolist())
+    db.flush()
+    return len(resultsDF)
+
+
+# Loads <prefix>_targets.csv and <prefix>_bins.csv (see length_effects) into the database
+def importLengthEffects(db, prefix):
+    if not os.path.exists(prefix + '_targets.csv'):
+        return
+    targetsDF = pd.read_csv(prefix + '_targets.csv', keep_default_na=False, na_values=['nan'],
+                            dtype={'Target': str})
+    binsDF = pd.read_csv(prefix + '_bins.csv', keep_default_na=False, na_values=['nan'])
+    db.addLengthEffects(targetsDF, binsDF)
+    db.flush()
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='results_db', description='Loads and queries an analysis results database')
+    parser.add_argument('db', type=str, help='the SQLite file')
+    parser.add_argument('-i', '--import', dest='imports', nargs='+', metavar='FILE', default=[],
+                        help='results files to load (csv or parquet directories, or --top tables)')
+    parser.add_argument('-a', '--alignment', type=str,
+                        help='alignment of imported files without an alignment column, and of the summary '
+                             '(default post-hoc for imports; the summary is otherwise grouped by alignment)')
+    parser.add_argument('-le', '--lengthEffects', nargs='+', metavar='PREFIX', default=[],
+                        help='length-effects files to load (<prefix>_targets.csv and <prefix>_bins.csv)')
+    parser.add_argument('-lex', '--lexicon', type=str, metavar='FILENAME',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data',
+                                             'lemmalex-with-trace-pronunciations-unique.csv'),
+                        help='lexicon with a Length column, for imported results')
+    parser.add_argument('-by', '--by', nargs='*', metavar='COLUMN',
+                        help='print n, accuracy and mean RT grouped by these results columns')
+    parser.add_argument('-wh', '--where', type=str, metavar='SQL', help='condition for the summary, e.g. "Length >= 6"')
+    parser.add_argument('-q', '--sql', type=str, help='run a query and print its result')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+    db = ResultsDB(args.db)
+    lengths = loadLengths(args.lexicon) if args.imports else {}
+    for path in args.imports:
+        print(str(importResults(db, path, args.alignment or 'post-hoc', lengths)) + ' rows from ' + path)
+    for prefix in args.lengthEffects:
+        importLengthEffects(db, prefix)
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        if args.by is not None:
+            print(db.summary(args.by, args.where, args.alignment).to_string(index=False))
+        if args.sql:
+            print(db.query(args.sql).to_string(index=False))
+    db.close()
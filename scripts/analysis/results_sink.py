@@ -0,0 +1,127 @@
+# Buffered results writer
+#
+# Rows are collected in one typed numpy array per column and written in batches
+# (every batchSize rows or every interval seconds), instead of one DataFrame and
+# one to_csv call per simulation. Two formats:
+#   csv       one file, appended batch by batch (header on the first batch)
+#   parquet   a dataset directory with one part-NNNNN.parquet per batch; each part
+#             is written to a temporary name and renamed, so a crash never leaves
+#             a broken file behind (temporary names start with a dot, so readers
+#             skip them). Read it back with pd.read_parquet(directory).
+#             Needs pyarrow.
+# state() flushes, fsyncs and returns what restore() needs to cut the output back
+# to that point (used by the --resume checkpoints).
+
+import glob
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+
+class ResultsSink:
+    def __init__(self, path, columns, types=None, format='csv', batchSize=500, interval=60.0):
+        if format == 'parquet':
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                raise ImportError('parquet output needs pyarrow (pip install pyarrow)')
+        elif format != 'csv':
+            raise ValueError('unknown results format ' + str(format))
+        self.path = path
+        self.columns = columns
+        self.types = {col: (types or {}).get(col, np.float64) for col in columns}
+        self.format = format
+        self.batchSize = batchSize
+        self.interval = interval
+        self.buffer = {col: np.empty(batchSize, dtype=self.types[col]) for col in columns}
+        self.rows = 0
+        self.lastFlush = time.time()
+
+    # Removes the output of an earlier run
+    def reset(self):
+        if self.format == 'parquet':
+            for part in self.parts():
+                os.remove(part)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def parts(self):
+        return sorted(glob.glob(os.path.join(self.path, 'part-*.parquet')))
+
+    # input: one value per column
+    def add(self, row):
+        for col, value in zip(self.columns, row):
+            self.buffer[col][self.rows] = value
+        self.rows = self.rows + 1
+        if self.rows == self.batchSize or time.time() - self.lastFlush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.lastFlush = time.time()
+        if self.rows == 0:
+            return
+        resultsDF = pd.DataFrame({col: self.buffer[col][:self.rows] for col in self.columns})
+        if self.format == 'parquet':
+            os.makedirs(self.path, exist_ok=True)
+            name = 'part-%05d.parquet' % len(self.parts())
+            tmp = os.path.join(self.path, '.' + name + '.tmp')
+            resultsDF.to_parquet(tmp, engine='pyarrow', index=False)
+            os.replace(tmp, os.path.join(self.path, name))
+        else:
+            header = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+            resultsDF.to_csv(self.path, mode='a', header=header, na_rep='nan', index=False)
+        self.rows = 0
+
+    def close(self):
+        self.flush()
+
+    # Flushes and fsyncs the output
+    # output: size of the csv file or number of parquet parts
+    def state(self):
+        self.flush()
+        if self.format == 'parquet':
+            if os.path.isdir(self.path):
+                fd = os.open(self.path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            return len(self.parts())
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, 'ab') as f:
+            os.fsync(f.fileno())
+        return os.path.getsize(self.path)
+
+    # Cuts the output back to a state(); with None (no checkpoint) only a partly
+    # written last csv row is dropped
+    def restore(self, state):
+        self.rows = 0
+        if self.format == 'parquet':
+            for part in (self.parts()[state:] if state is not None else []):
+                os.remove(part)
+        elif os.path.exists(self.path):
+            if state is not None:
+                os.truncate(self.path, state)
+            else:
+                with open(self.path, 'rb+') as f:
+                    data = f.read()
+                    f.truncate(data.rfind(b'\n') + 1)
+
+    # Whether there is earlier output (to resume from)
+    def exists(self):
+        return len(self.parts()) > 0 if self.format == 'parquet' else os.path.exists(self.path)
+
+    # output: set of (param_combo, Target) keys already written, as strings
+    def completed(self):
+        if self.format == 'parquet':
+            if not self.parts():
+                return set()
+            done = pd.concat([pd.read_parquet(part, columns=['param_combo', 'Target']) for part in self.parts()])
+        else:
+            if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+                return set()
+            done = pd.read_csv(self.path, usecols=['param_combo', 'Target'], dtype=str, keep_default_na=False)
+        return set(zip(done['param_combo'].astype(str), done['Target']))
@@ -0,0 +1,174 @@
+# Cache of analysis runs
+#
+# The same battery is often analyzed again with the same settings, by other
+# people or by batch scripts. With --cache DIR a finished run stores copies of its
+# outputs (results, sweep, --top table, length effects) under a key made of
+#   - the sha256 of every input file (for a store or summary directory, of every
+#     file in it),
+#   - the settings the outputs depend on (Analysis.cacheSettings), and
+#   - the sha256 of the rhymes/cohorts table and of the lexicon,
+# and a later run with the same key copies them back instead of reading the input.
+# A run with --summary also registers its summary directory under the input hashes,
+# so a run that only changes the threshold (or a Luce k the summary has) analyzes
+# the summary instead of parsing the word data again.
+#
+# Hashes are remembered by path, size and modification time (hashes.json), so an
+# unchanged multi-GB input is only hashed once. DIR can be shared; entries are
+# written to a temporary name and renamed.
+#   DIR/hashes.json            path -> size, mtime, sha256
+#   DIR/runs/<key>/            manifest.json (settings and output roles) and the output files
+#   DIR/summaries/<inputs>.json   summary directories written from these inputs
+
+import hashlib
+import json
+import os
+import shutil
+
+# Bump when the outputs of the same settings change, so old entries are not used
+CACHE_VERSION = 1
+
+
+def sha256(path, blockSize=1 << 24):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(blockSize), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+# sha256 of a json-able value (dict keys sorted)
+def valueHash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()
+
+
+# Writes a json file under a temporary name and renames it
+def writeJson(path, value):
+    tmp = path + '.tmp' + str(os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(value, f, indent=1)
+    os.replace(tmp, path)
+
+
+def copyOutput(src, dst):
+    if os.path.isdir(src):
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        shutil.copytree(src, dst)
+    else:
+        shutil.copyfile(src, dst)
+
+
+class RunCache:
+    def __init__(self, path):
+        self.path = path
+        self.hashesfile = os.path.join(path, 'hashes.json')
+        for sub in ('runs', 'summaries'):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+        self.hashes = self.readJson(self.hashesfile, {})
+
+    @staticmethod
+    def readJson(path, default):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return default
+
+    # sha256 of a file, from hashes.json while its size and mtime are unchanged
+    def fileHash(self, path):
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = self.hashes.get(path)
+        if known and known['size'] == stat.st_size and known['mtime'] == stat.st_mtime:
+            return known['sha256']
+        digest = sha256(path)
+        self.hashes = self.readJson(self.hashesfile, {})
+        self.hashes[path] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha256': digest}
+        writeJson(self.hashesfile, self.hashes)
+        return digest
+
+    # sha256 of a word-data file, or of the names and contents of every file in a
+    # store / summary directory (sidecar .index directories are not part of the input)
+    def inputHash(self, path):
+        if not os.path.isdir(path):
+            return self.fileHash(path)
+        digest = hashlib.sha256()
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                full = os.path.join(root, name)
+                digest.update(os.path.relpath(full, path).encode() + b'\0' + self.fileHash(full).encode())
+        return digest.hexdigest()
+
+    # Key of a run
+    # input: input paths, settings (json-able)
+    # output: hex digest
+    def key(self, inputs, settings):
+        return valueHash({'version': CACHE_VERSION, 'inputs': [self.inputHash(path) for path in inputs],
+                          'settings': settings})
+
+    def entry(self, key):
+        return os.path.join(self.path, 'runs', key)
+
+    # Copies the outputs of a cached run to their paths
+    # input: key, list of (role, path) the run writes
+    # output: whether the run was cached
+    def restore(self, key, outputs):
+        manifest = self.readJson(os.path.join(self.entry(key), 'manifest.json'), None)
+        if manifest is None or [role for role, path in outputs] != [o['role'] for o in manifest['outputs']]:
+            return False
+        for (role, path), stored in zip(outputs, manifest['outputs']):
+            if stored['file'] is None:
+                if os.path.exists(path):
+                    shutil.rmtree(path) if os.path.isdir(path) else os.remove(path)
+            else:
+                copyOutput(os.path.join(self.entry(key), stored['file']), path)
+        return True
+
+    # Stores the outputs of a finished run (outputs that were not written are
+    # recorded as missing, and removed again on restore)
+    # input: key, settings, list of (role, path)
+    def save(self, key, settings, outputs):
+        if os.path.exists(self.entry(key)):
+            return
+        tmp = os.path.join(self.path, 'runs', '.' + key + '.tmp' + str(os.getpid()))
+        os.makedirs(tmp)
+        stored = []
+        for n, (role, path) in enumerate(outputs):
+            name = None
+            if os.path.exists(path):
+                name = '%02d_%s' % (n, os.path.basename(os.path.normpath(path)))
+                copyOutput(path, os.path.join(tmp, name))
+            stored.append({'role': role, 'file': name})
+        writeJson(os.path.join(tmp, 'manifest.json'), {'settings': settings, 'outputs': stored})
+        try:
+            os.rename(tmp, self.entry(key))
+        except OSError:
+            # another run stored the same key first
+            shutil.rmtree(tmp)
+
+    def summariesFile(self, inputs):
+        return os.path.join(self.path, 'summaries', valueHash([self.inputHash(path) for path in inputs]) + '.json')
+
+    # Registers a summary directory written from these inputs
+    # input: input paths, summary directory, what else the summary depends on
+    #        (relations and lexicon hashes, --combos / --targets)
+    def addSummary(self, inputs, summary, settings):
+        path = self.summariesFile(inputs)
+        summary = os.path.abspath(summary)
+        entries = [e for e in self.readJson(path, []) if e['path'] != summary]
+        entries.append({'path': summary, 'settings': settings, 'sha256': self.inputHash(summary)})
+        writeJson(path, entries)
+
+    # Summary directories registered for these inputs that still exist unchanged
+    # output: list of (path, settings)
+    def summaries(self, inputs):
+        found = []
+        for e in self.readJson(self.summariesFile(inputs), []):
+            try:
+                if os.path.exists(os.path.join(e['path'], 'summary.json')) and \
+                        self.inputHash(e['path']) == e['sha256']:
+                    found.append((e['path'], e['settings']))
+            except OSError:
+                pass
+        return found
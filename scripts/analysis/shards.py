@@ -0,0 +1,89 @@
+# Sharded inputs
+#
+# A battery is often split over several word-data files (e.g. the 1000lex runs
+# in fifths). The analysis accepts a glob pattern or a directory of such files;
+# every shard is analyzed on its own (see Analysis.processShards) and the shard
+# outputs are merged here into one results file per alignment, one sweep table and
+# one set of length-effects files (see length_effects.mergeFiles).
+
+import glob
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+from length_effects import SIM_KEY, SIM_ORDER
+
+
+# Input files of a run
+# input: file, glob pattern, store or summary directory or directory of word-data files
+#        (*.csv.gz or *-word.csv, so outputs written next to them are skipped)
+# output: sorted list of paths (a store or summary directory is one input)
+def expandInputs(pattern):
+    pattern = str(pattern)
+    if os.path.isdir(pattern):
+        if any(os.path.exists(os.path.join(pattern, name)) for name in ('store.json', 'summary.json')):
+            return [pattern]
+        return sorted(glob.glob(os.path.join(pattern, '*.csv.gz')) + glob.glob(os.path.join(pattern, '*-word.csv')))
+    if glob.has_magic(pattern):
+        return sorted(glob.glob(pattern))
+    return [pattern]
+
+
+# Base name for the outputs of an input: the input itself, 'stdin' for '-', or for
+# a pattern or a directory of shards the pattern without wildcards / the directory path
+def inputName(pattern):
+    pattern = str(pattern)
+    if pattern == '-':
+        return 'stdin'
+    if glob.has_magic(pattern):
+        return re.sub(r'[*?\[\]]', '', pattern)
+    return pattern.rstrip('/' + os.sep) or pattern
+
+
+def readResults(path, format):
+    if format == 'parquet':
+        parts = sorted(glob.glob(os.path.join(path, 'part-*.parquet')))
+        return pd.concat([pd.read_parquet(part) for part in parts], ignore_index=True)
+    return pd.read_csv(path, keep_default_na=False, na_values=['nan'], dtype={'Target': str})
+
+
+# Merges shard results (or --top tables): rows of a simulation (parameter values,
+# param_combo and Target) analyzed in more than one shard are kept once (first
+# shard wins), and rows are ordered by param_combo, parameter values and Target
+# input: shard results paths, output path, 'csv' or 'parquet'
+# output: number of rows written
+def mergeResults(paths, outpath, format):
+    frames = [readResults(path, format) for path in paths if os.path.exists(path)]
+    if not frames:
+        return 0
+    resultsDF = pd.concat(frames, ignore_index=True)
+    keys = SIM_KEY + [key for key in ('alignment', 'rank') if key in resultsDF]
+    resultsDF = resultsDF.drop_duplicates(keys).sort_values(SIM_ORDER, kind='stable')
+    if format == 'parquet':
+        os.makedirs(outpath, exist_ok=True)
+        for part in glob.glob(os.path.join(outpath, 'part-*.parquet')):
+            os.remove(part)
+        resultsDF.to_parquet(os.path.join(outpath, 'part-00000.parquet'), engine='pyarrow', index=False)
+    else:
+        resultsDF.to_csv(outpath, na_rep='nan', index=False)
+    return len(resultsDF)
+
+
+# Merges shard sweep tables. They are aggregates, so shards must not overlap:
+# counts add up and mean RTs are weighted by the recognized simulations
+def mergeSweeps(paths, outpath):
+    frames = [pd.read_csv(path) for path in paths if os.path.exists(path)]
+    if not frames:
+        return
+    sweepDF = pd.concat(frames, ignore_index=True)
+    keys = [col for col in sweepDF.columns if col not in ('n', 'accuracy', 'mean_RT')]
+    sweepDF['recognized'] = sweepDF['accuracy'] * sweepDF['n']
+    sweepDF['rtSum'] = np.where(sweepDF['recognized'] > 0, sweepDF['mean_RT'] * sweepDF['recognized'], 0)
+    merged = sweepDF.groupby(keys, sort=False)[['n', 'recognized', 'rtSum']].sum().reset_index()
+    merged['accuracy'] = merged['recognized'] / merged['n']
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged['mean_RT'] = merged['rtSum'] / merged['recognized']
+    merged = merged.sort_values(['param_combo'] + [k for k in ('lucek', 'thresh') if k in keys], kind='stable')
+    merged[keys + ['n', 'accuracy', 'mean_RT']].to_csv(outpath, na_rep='nan', index=False)
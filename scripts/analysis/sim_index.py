@@ -0,0 +1,210 @@
+# Sidecar index of a word-data file
+#
+# While a word-data file is read from start to end (by this script, or by the
+# analysis with --index) we note where every simulation starts, and for gzip
+# files a set of gzip access points (the decompressor state every SPACING bytes of
+# output, kept by indexed_gzip). Both go next to the file, in <file>.index/:
+#   index.csv      one row per simulation: position, offset and length in the
+#                  uncompressed data, and the metadata
+#   index.json     size and modification time of the file it describes
+#   access.gzidx   indexed_gzip access points
+# With the index one simulation is read with a seek: plain files seek directly,
+# gzip files decompress from the nearest access point. indexed_gzip is a
+# requirement (requirements.txt) for that: Python's zlib cannot save or restore a
+# decompressor midway. Without it gzip files still work, with a warning, but every
+# seek decompresses from the start of the file. SimIndex has the same interface
+# as SimStore, so the analysis reads --combos / --targets selections through it.
+#
+# usage: python sim_index.py sim-1000lex-word.csv.gz [-tg bIt] [-cb 12]
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from sim_reader import META_HEADER, iterChunks, parseBlock, parseMeta
+
+try:
+    import indexed_gzip
+except ImportError:
+    indexed_gzip = None
+
+# uncompressed bytes between two access points (each keeps a 32 KB window)
+SPACING = 1 << 24
+
+
+def indexDir(path):
+    return str(path) + '.index'
+
+
+def isGzip(path):
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def warnNoAccessPoints(path):
+    warnings.warn('indexed_gzip is not installed (pip install -r requirements.txt): ' + str(path) +
+                  ' has no gzip access points, so every simulation read with a seek decompresses the file '
+                  'from its start', stacklevel=3)
+
+
+# Opens a word-data file for one pass that also records gzip access points (see
+# above). Like gzip.open, the reader has the underlying file as .fileobj (for
+# progress reports)
+def openForIndexing(path):
+    if not isGzip(path):
+        return open(path, 'rb')
+    if indexed_gzip is None:
+        warnNoAccessPoints(path)
+        return gzip.open(path, 'rb')
+    raw = open(path, 'rb')
+    f = indexed_gzip.IndexedGzipFile(fileobj=raw, spacing=SPACING)
+    f.fileobj = raw
+    return f
+
+
+# Writes the index of a file while it is read. Rows go to a temporary file, so an
+# interrupted pass leaves no index behind
+class IndexWriter:
+    def __init__(self, path):
+        self.path = path
+        self.dir = indexDir(path)
+        os.makedirs(self.dir, exist_ok=True)
+        self.tmp = os.path.join(self.dir, '.index.csv.tmp')
+        self.f = open(self.tmp, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(['sim', 'offset', 'bytes'] + META_HEADER)
+        self.count = 0
+
+    def add(self, offset, size, meta):
+        self.writer.writerow([self.count, offset, size] + [meta[h] for h in META_HEADER])
+        self.count = self.count + 1
+
+    # input: the file object the simulations were read from (its access points
+    #        are saved when it is an indexed_gzip file)
+    def close(self, f):
+        self.f.close()
+        access = None
+        if indexed_gzip is not None and isinstance(f, indexed_gzip.IndexedGzipFile):
+            access = 'access.gzidx'
+            f.export_index(os.path.join(self.dir, access))
+        os.replace(self.tmp, os.path.join(self.dir, 'index.csv'))
+        stat = os.stat(self.path)
+        header = {'source': os.path.basename(str(self.path)), 'simulations': self.count, 'size': stat.st_size,
+                  'mtime': stat.st_mtime, 'access': access, 'spacing': SPACING}
+        with open(os.path.join(self.dir, 'index.json'), 'w') as out:
+            json.dump(header, out)
+
+
+# Reads a whole file once to index it
+# output: number of simulations
+def build(path):
+    with openForIndexing(path) as f:
+        writer = IndexWriter(path)
+        for offset, block in iterChunks(f):
+            writer.add(offset, len(block), parseMeta(block[:block.index(b'\n')]))
+        writer.close(f)
+    return writer.count
+
+
+# Random access to the simulations of an indexed word-data file. Pickling (e.g.
+# to worker processes) only sends the index and each process opens the file itself
+class SimIndex:
+    def __init__(self, path):
+        self.path = path
+        self.dir = indexDir(path)
+        with open(os.path.join(self.dir, 'index.json')) as f:
+            self.header = json.load(f)
+        self.index = pd.read_csv(os.path.join(self.dir, 'index.csv'), dtype={'Target': str, 'Fullstring': str},
+                                 keep_default_na=False)
+        self.open()
+
+    # Whether a file has an index that is up to date
+    @staticmethod
+    def fresh(path):
+        try:
+            with open(os.path.join(indexDir(path), 'index.json')) as f:
+                header = json.load(f)
+            stat = os.stat(path)
+        except (OSError, ValueError):
+            return False
+        return header['size'] == stat.st_size and header['mtime'] == stat.st_mtime
+
+    def open(self):
+        if not isGzip(self.path):
+            self.f = open(self.path, 'rb')
+        elif indexed_gzip is not None:
+            access = self.header['access'] and os.path.join(self.dir, self.header['access'])
+            self.f = indexed_gzip.IndexedGzipFile(self.path, spacing=SPACING, index_file=access)
+        else:
+            warnNoAccessPoints(self.path)
+            self.f = gzip.open(self.path, 'rb')
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['f']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return len(self.index)
+
+    # Metadata of one simulation, as sim_reader.parseMeta returns it
+    def meta(self, i):
+        row = self.index.iloc[i]
+        return {h: (row[h].item() if hasattr(row[h], 'item') else row[h]) for h in META_HEADER}
+
+    # Rows of one simulation, as iterChunks yields them
+    def block(self, i):
+        row = self.index.iloc[i]
+        self.f.seek(int(row['offset']))
+        return self.f.read(int(row['bytes']))
+
+    def simulation(self, i):
+        return parseBlock(self.block(i))
+
+    # Positions of the simulations matching the given combos and/or targets
+    def select(self, param_combos=None, targets=None):
+        keep = np.ones(len(self), dtype=bool)
+        if param_combos is not None:
+            keep &= self.index['param_combo'].isin(param_combos).to_numpy()
+        if targets is not None:
+            keep &= self.index['Target'].isin(targets).to_numpy()
+        return np.flatnonzero(keep)
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='sim_index',
+                                     description='Indexes a tracejs word-data file and shows single simulations')
+    parser.add_argument('File', metavar='file', type=str, help='the csv(.gz) file')
+    parser.add_argument('-cb', '--combos', action='store', type=int, nargs='+', metavar='COMBO',
+                        help='show these param_combo values')
+    parser.add_argument('-tg', '--targets', action='store', type=str, nargs='+', metavar='TARGET',
+                        help='show these targets')
+    parser.add_argument('-n', '--top', action='store', type=int, default=5, help='most activated words to show')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+    if not SimIndex.fresh(args.File):
+        print(str(build(args.File)) + ' simulations indexed in ' + indexDir(args.File))
+    index = SimIndex(args.File)
+    if args.combos is None and args.targets is None:
+        print(index.index.groupby('param_combo').size().to_string())
+    for i in (index.select(args.combos, args.targets) if args.combos or args.targets else []):
+        sim = index.simulation(i)
+        peak = sim.acts.max(axis=(1, 2))
+        print(sim.meta)
+        print('  ' + str(len(sim.words)) + ' words, ' + str(sim.acts.shape[1]) + ' cycles')
+        for w in np.argsort(-peak, kind='stable')[:args.top]:
+            copy, cycle = divmod(int(sim.acts[w].T.argmax()), sim.acts.shape[1])
+            print('  %-12s peak %.4f at cycle %d, copy %d' % (sim.words[w], peak[w], cycle, copy + 1))
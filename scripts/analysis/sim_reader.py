@@ -0,0 +1,302 @@
+# Streaming reader for tracejs word-data files (sim-*-word.csv.gz)
+#
+# tracejs (serializeData in trace-sim-base.ts) writes one row per word and cycle:
+#   Cycle, Fullstring, Target, alpha_if, alpha_pw, alpha_fp, alpha_wp, gamma_f, gamma_p, gamma_w, param_combo, Word,c1,...,c33
+# with rows word-major and then cycle-major, and every copy value printed with
+# toFixed(4). Because the layout is that rigid we can skip the csv machinery:
+# we find newlines and commas with numpy, rebuild the four-decimal values from
+# their digits and only decode the few prefix fields we actually need.
+#
+# The file does not say how many words and cycles a simulation has (a different
+# lexicon or a run capped by maxDuration changes both), so simulations are split
+# where the prefix (Fullstring, Target, ..., param_combo) of a cycle-0 row changes,
+# and the number of cycles is read off the rows of the first word.
+#
+# The input does not have to be a file on disk: '-' reads stdin and a named pipe
+# (mkfifo) is read as it is written, plain or gzip, e.g.
+#   node simulation-1000lex.js --stdout | python v5_sg_analysis_jm_test_battery_flex2.py - -c 100
+# A simulation is passed on as soon as its words x cycles rows have arrived, and
+# since only a couple of simulations are read ahead, a slow analysis makes the
+# pipe fill up and the simulation wait (backpressure) instead of using memory.
+
+import gzip
+import os
+import queue
+import stat
+import sys
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+COPIES = 33
+INPUT_HEADER = ["Cycle", "Fullstring", "Target", "alpha_if", "alpha_pw", 'alpha_fp', "alpha_wp", "gamma_f",
+                "gamma_p", "gamma_w", "param_combo", "Word"] + list(range(1, COPIES + 1))
+META_HEADER = INPUT_HEADER[1:11]
+PREFIX_FIELDS = len(INPUT_HEADER) - COPIES
+COMMAS_PER_ROW = len(INPUT_HEADER) - 1
+
+NEWLINE = ord('\n')
+COMMA = ord(',')
+DOT = ord('.')
+MINUS = ord('-')
+ZERO = ord('0')
+
+# One simulation: meta is a dict of the prefix fields (Fullstring, Target, alpha/gamma
+# values, param_combo), words the lexicon in file order, acts a (words, cycles, 33) array
+Simulation = namedtuple('Simulation', ['meta', 'words', 'acts'])
+
+
+# Whether the input is a stream (stdin or a named pipe) rather than a file we can
+# seek in and take the size of
+def isStream(path):
+    if path == '-':
+        return True
+    try:
+        return not stat.S_ISREG(os.stat(path).st_mode)
+    except OSError:
+        return False
+
+
+# Opens a simulation file or stream for binary reading; gzip is detected from the
+# magic bytes
+def openSimFile(path):
+    if isStream(path):
+        f = sys.stdin.buffer if path == '-' else open(path, 'rb')
+        if f.peek(2)[:2] == b'\x1f\x8b':
+            return StreamGzipFile(f)
+        return f
+    f = open(path, 'rb')
+    if f.peek(2)[:2] == b'\x1f\x8b':
+        f.close()
+        return gzip.open(path, 'rb')
+    return f
+
+
+# gzip reader on top of a stream that also closes the stream
+class StreamGzipFile(gzip.GzipFile):
+    def __init__(self, f):
+        super().__init__(fileobj=f, mode='rb')
+        self.stream = f
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self.stream.close()
+
+
+# Converts a prefix field the way read_csv would (ints stay ints)
+def toNumber(field):
+    try:
+        return int(field)
+    except ValueError:
+        return float(field)
+
+
+# Splits a row's prefix into the simulation metadata
+# input: one row (bytes)
+# output: dict keyed by META_HEADER
+def parseMeta(row):
+    fields = [x.strip() for x in row.decode().split(',', PREFIX_FIELDS)[:PREFIX_FIELDS]]
+    meta = dict(zip(META_HEADER, fields[1:11]))
+    for key in META_HEADER[2:]:
+        meta[key] = toNumber(meta[key])
+    return meta
+
+
+# Prefix of a row as it is written: from the comma after Cycle up to and
+# including the comma after param_combo, and the same followed by the word
+def rowKey(row):
+    fields = row.split(b',', PREFIX_FIELDS)
+    if fields[0].strip() != b'0':
+        raise ValueError('simulation does not start at cycle 0 (' + row[:80].decode(errors='replace') + ')')
+    key = b',' + b','.join(fields[1:PREFIX_FIELDS - 1]) + b','
+    return key, key + fields[PREFIX_FIELDS - 1] + b','
+
+
+# Position of the first row of the next simulation: a cycle-0 row whose prefix is
+# not the current one, or that starts the current simulation's first word again
+# (the same simulation written twice in a row)
+# input: byte array, start positions of the cycle-0 rows to check, prefix and
+#        prefix + first word of the current simulation
+# output: position, or None if all rows belong to the current simulation
+def findBoundary(arr, starts, key, first):
+    if len(starts) == 0:
+        return None
+    # check the rows in growing batches, so a buffer holding many small
+    # simulations is not compared in full once per simulation
+    pattern = np.frombuffer(first, np.uint8)
+    batch = 256
+    for at in range(0, len(starts), batch):
+        rows = starts[at:at + batch]
+        batch = batch * 2
+        positions = np.minimum(rows[:, None] + 1 + np.arange(len(pattern)), len(arr) - 1)
+        same = arr[positions] == pattern
+        changed = ~same[:, :len(key)].all(axis=1) | same.all(axis=1)
+        if changed.any():
+            return int(rows[changed.argmax()])
+    return None
+
+
+# Reads a binary stream and yields one block of rows per simulation
+# input: file object, read size, whether to pass on whatever has arrived
+#        (streams) rather than wait for readSize bytes (files)
+# output: generator of (byte offset in the uncompressed data, bytes of the block)
+def iterChunks(f, readSize=1 << 24, stream=False):
+    read = f.read1 if stream else f.read
+    pieces = []  # rows of the current simulation read so far
+    words = 0  # cycle-0 rows, one per word
+    lastWords = None
+    start = 0  # offset of the current simulation
+    key = None
+    carry = b''  # incomplete last row of the previous read
+    while True:
+        data = read(readSize)
+        if not data:
+            break
+        buf = carry + data if carry else data
+        end = buf.rfind(b'\n') + 1
+        carry = buf[end:]
+        if end == 0:
+            continue
+        buf = buf[:end]
+
+        arr = np.frombuffer(buf, np.uint8)
+        newlines = np.flatnonzero(arr == NEWLINE)
+        rowStarts = np.concatenate(([0], newlines[:-1] + 1))
+        cycle0 = rowStarts[(arr[rowStarts] == ZERO) & (arr[np.minimum(rowStarts + 1, len(arr) - 1)] == COMMA)]
+        pos = 0
+        while pos < len(buf):
+            check = cycle0[np.searchsorted(cycle0, pos):]
+            if key is None:
+                key, first = rowKey(buf[pos:buf.index(b'\n', pos)])
+                check = check[1:]
+            cut = findBoundary(arr, check, key, first)
+            if cut is None:
+                cut = len(buf)
+            pieces.append(buf[pos:cut])
+            words += int(np.searchsorted(cycle0, cut) - np.searchsorted(cycle0, pos))
+            if cut < len(buf):
+                block = b''.join(pieces)
+                yield start, block
+                start += len(block)
+                pieces = []
+                lastWords, words = words, 0
+                key = None
+            pos = cut
+
+    if carry.strip():
+        raise ValueError('file ends with an incomplete row')
+    if pieces:
+        # a simulation cut off between two words still parses, so compare it
+        # with the one before (all simulations of a file use the same lexicon)
+        if lastWords is not None and words != lastWords:
+            raise ValueError('file ends with an incomplete simulation (' + str(words) + ' of ' + str(lastWords) +
+                             ' words)')
+        yield start, b''.join(pieces)
+
+
+# Rebuilds the copy values from their digits. Every value is [-]D.DDDD, so a value
+# is its integer digit plus four decimals; anything else returns None
+# input: byte array of the block, (rows, 33) positions of the first character
+#        and one past the last character of each value
+def parseFixed(arr, starts, ends):
+    widths = ends - starts
+    negative = arr[starts] == MINUS
+    if not (((widths == 6) | ((widths == 7) & negative)).all() and (arr[ends - 5] == DOT).all()):
+        return None
+
+    digits = [arr[ends - k].astype(np.int32) - ZERO for k in (6, 4, 3, 2, 1)]
+    if not all(((d >= 0) & (d <= 9)).all() for d in digits):
+        return None
+
+    value = digits[0] * 10000 + digits[1] * 1000 + digits[2] * 100 + digits[3] * 10 + digits[4]
+    return np.where(negative, -value, value) / 10000.0
+
+
+# Parses one block (all rows of one simulation)
+# input: bytes of words * cycles rows, number of cycles (default: the rows of the
+#        first word)
+# output: Simulation
+def parseBlock(block, cycles=None, dtype=np.float64):
+    arr = np.frombuffer(block, np.uint8)
+    newlines = np.flatnonzero(arr == NEWLINE)
+    nrows = len(newlines)
+    rowStarts = np.concatenate(([0], newlines[:-1] + 1))
+    if cycles is None:
+        cycle0 = np.flatnonzero((arr[rowStarts] == ZERO) & (arr[rowStarts + 1] == COMMA))
+        cycles = int(cycle0[1]) if len(cycle0) > 1 else nrows
+    nwords = nrows // cycles
+    if nwords * cycles != nrows:
+        raise ValueError('block of ' + str(nrows) + ' rows is not a multiple of ' + str(cycles) + ' cycles')
+
+    commas = np.flatnonzero(arr == COMMA)
+    if len(commas) != nrows * COMMAS_PER_ROW:
+        raise ValueError('block does not have ' + str(len(INPUT_HEADER)) + ' fields on every row')
+    commas = commas.reshape(nrows, COMMAS_PER_ROW)
+
+    # rows must be word-major, then cycle-major
+    cycleWidth = commas[:, 0] - rowStarts
+    if cycleWidth.max() > 6:
+        raise ValueError('unexpected Cycle field')
+    cycle = np.zeros(nrows, np.int64)
+    for k in range(1, cycleWidth.max() + 1):
+        hasDigit = cycleWidth >= k
+        cycle[hasDigit] = cycle[hasDigit] * 10 + arr[rowStarts[hasDigit] + k - 1] - ZERO
+    if not (cycle.reshape(nwords, cycles) == np.arange(cycles)).all():
+        raise ValueError('block rows are not ordered word-major, then cycle-major')
+
+    meta = parseMeta(block[:newlines[0]])
+    if parseMeta(block[rowStarts[-1]:newlines[-1]]) != meta:
+        raise ValueError('block spans more than one simulation (' + meta['Target'] + ')')
+
+    wordRows = np.arange(0, nrows, cycles)
+    words = np.array([block[a + 1:b].decode().strip()
+                      for a, b in zip(commas[wordRows, PREFIX_FIELDS - 2], commas[wordRows, PREFIX_FIELDS - 1])],
+                     dtype=object)
+
+    starts = commas[:, PREFIX_FIELDS - 1:] + 1
+    ends = np.concatenate((commas[:, PREFIX_FIELDS:], newlines[:, None]), axis=1)
+    values = parseFixed(arr, starts, ends)
+    if values is None:
+        values = np.array([float(x) for a, b in zip(starts[:, 0], newlines) for x in block[a:b].split(b',')])
+
+    acts = values.astype(dtype, copy=False).reshape(nwords, cycles, COPIES)
+    return Simulation(meta, words, acts)
+
+
+# Runs a block generator in a background thread. zlib and most numpy calls
+# release the GIL, so decompressing the next simulation overlaps with parsing
+# and analysing the current one
+# input: generator of blocks, number of blocks to read ahead
+# output: generator of the same blocks
+def prefetch(blocks, ahead=2):
+    q = queue.Queue(maxsize=ahead)
+    done = object()
+
+    def fill():
+        try:
+            for block in blocks:
+                q.put(block)
+        except BaseException as e:
+            q.put(e)
+        q.put(done)
+
+    threading.Thread(target=fill, daemon=True).start()
+    while True:
+        block = q.get()
+        if block is done:
+            return
+        if isinstance(block, BaseException):
+            raise block
+        yield block
+
+
+# Streams all simulations of a word-data file
+# input: path
+# output: generator of Simulation
+def readSimulations(path, dtype=np.float64):
+    with openSimFile(path) as f:
+        for offset, block in prefetch(iterChunks(f, stream=isStream(path))):
+            yield parseBlock(block, dtype=dtype)
@@ -0,0 +1,127 @@
+# Memory-mapped simulation store
+#
+# Converts a tracejs word-data file (sim-*-word.csv.gz) once into a directory that
+# can be analyzed any number of times without decompressing or parsing:
+#   activations.bin   simulation x word x cycle x copy, float32 or int16 (value * 10000)
+#   index.csv         one row per simulation: position, byte offset and the metadata
+#                     (Fullstring, Target, alpha/gamma values, param_combo)
+#   store.json        shape, dtype, scale and the words in lexicon order
+#
+# usage: python sim_store.py sim-1000lex-word.csv.gz sim-1000lex-store [--int16]
+
+import argparse
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from sim_reader import COPIES, META_HEADER, Simulation, isStream, iterChunks, openSimFile, parseBlock, prefetch
+
+# copy values are written with 4 decimals, so int16 * 1/10000 is lossless
+SCALE = 10000
+
+
+# Converts a word-data file into a store directory
+# input: word-data file, store directory, 'float32' or 'int16'
+# output: number of simulations written
+def convert(path, store, dtype='float32'):
+    os.makedirs(store, exist_ok=True)
+    rows = []
+    lexicon = None
+    cycles = None
+
+    with openSimFile(path) as f, open(os.path.join(store, 'activations.bin'), 'wb') as out:
+        for offset, block in prefetch(iterChunks(f, stream=isStream(path))):
+            sim = parseBlock(block)
+            if lexicon is None:
+                lexicon = list(sim.words)
+                cycles = sim.acts.shape[1]
+                simBytes = sim.acts.size * np.dtype(dtype).itemsize
+            elif list(sim.words) != lexicon or sim.acts.shape[1] != cycles:
+                raise ValueError('word order or cycles change at ' + sim.meta['Target'] + ', combo ' +
+                                 str(sim.meta['param_combo']))
+
+            if dtype == 'int16':
+                out.write(np.rint(sim.acts * SCALE).astype(np.int16).tobytes())
+            else:
+                out.write(sim.acts.astype(dtype).tobytes())
+            rows.append([len(rows), len(rows) * simBytes] + [sim.meta[h] for h in META_HEADER])
+
+    pd.DataFrame(rows, columns=['sim', 'offset'] + META_HEADER).to_csv(os.path.join(store, 'index.csv'),
+                                                                       index=False)
+    header = {'source': os.path.basename(str(path)), 'simulations': len(rows), 'words': len(lexicon or []),
+              'cycles': cycles,
+              'copies': COPIES, 'dtype': dtype, 'scale': SCALE if dtype == 'int16' else 1,
+              'lexicon': lexicon or []}
+    with open(os.path.join(store, 'store.json'), 'w') as f:
+        json.dump(header, f)
+    return len(rows)
+
+
+# Read-only view of a store directory. Simulations are sliced out of a np.memmap,
+# so any subset can be read in any order; pickling (e.g. to worker processes)
+# only sends the path and each process maps the file itself
+class SimStore:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'store.json')) as f:
+            self.header = json.load(f)
+        self.index = pd.read_csv(os.path.join(path, 'index.csv'), dtype={'Target': str, 'Fullstring': str},
+                                 keep_default_na=False)
+        self.words = np.array(self.header['lexicon'], dtype=object)
+        self.cycles = self.header['cycles']
+        self.open()
+
+    def open(self):
+        self.data = np.memmap(os.path.join(self.path, 'activations.bin'), dtype=self.header['dtype'], mode='r',
+                              shape=(self.header['simulations'], self.header['words'], self.header['cycles'],
+                                     self.header['copies']))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return self.header['simulations']
+
+    # Metadata of one simulation, as sim_reader.parseMeta returns it
+    def meta(self, i):
+        row = self.index.iloc[i]
+        return {h: (row[h].item() if hasattr(row[h], 'item') else row[h]) for h in META_HEADER}
+
+    # input: simulation position
+    # output: Simulation with a float64 (words, cycles, copies) array. Values are
+    # rounded back to tracejs' 4 decimals, so they are exactly what sim_reader parses
+    def simulation(self, i):
+        acts = np.asarray(self.data[i], dtype=np.float64) * (SCALE / self.header['scale'])
+        return Simulation(self.meta(i), self.words, np.rint(acts) / SCALE)
+
+    # Positions of the simulations matching the given combos and/or targets
+    def select(self, param_combos=None, targets=None):
+        keep = np.ones(len(self), dtype=bool)
+        if param_combos is not None:
+            keep &= self.index['param_combo'].isin(param_combos).to_numpy()
+        if targets is not None:
+            keep &= self.index['Target'].isin(targets).to_numpy()
+        return np.flatnonzero(keep)
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='sim_store',
+                                     description='Converts a tracejs word-data file into a memory-mapped store')
+    parser.add_argument('File', metavar='file', type=str, help="the csv(.gz) file to convert ('-' for stdin)")
+    parser.add_argument('store', type=str, help='output directory')
+    parser.add_argument('--int16', action='store_true', help='store values as int16 (half the size of float32)')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+    n = convert(args.File, args.store, 'int16' if args.int16 else 'float32')
+    print(str(n) + ' simulations written to ' + args.store)
@@ -0,0 +1,237 @@
+# Per-simulation summaries
+#
+# Everything the analysis reports comes from a few reductions of each word-unit
+# selection: every word's peak, the target trajectory, the two most activated
+# words at every cycle and the mean cohort / rhyme / unrelated trajectories. With
+# --summary DIR the analysis writes those reductions while it reads the word data,
+# and DIR can later be given as the input (other thresholds, a --sweep) without
+# the raw file:
+#   summaries.bin   one fixed-size record per simulation (see summaryDtype):
+#                   argmaxCopy (words,)             copy (1-33) of each word's peak
+#                   targetWord ()                   column of the target
+#                   and for every alignment
+#                     peak (words,)                 each word's peak, int16 (value * 10000)
+#                     peakCycle (words,)            cycle of the peak
+#                     target (cycles,)              target trajectory, int16
+#                     top, topWords (2, cycles)     the two most activated eval words at
+#                                                   every cycle (int16) and their columns
+#                     competitors (N, cycles)       trajectories of the N strongest other
+#                     competitorWords (N,)          eval words, and their columns (-1: none)
+#                     relations (3, cycles)         mean cohort, rhyme and unrelated
+#                                                   trajectories (NaN if there are none)
+#                     lse (k values, cycles)        log-sum-exp of k * activation over the
+#                                                   eval words (the Luce rule denominator)
+#   index.csv       one row per simulation: position and the metadata
+#   summary.json    shapes, the settings the summaries depend on (alignments,
+#                   topSlices, Luce k grid, relations file) and the lexicon
+# For 14679 words and 100 cycles a record is about 80 KB per alignment, against
+# about 190 MB of float32 activations.
+#
+# Records are appended as simulations come in, so a summary can be checkpointed
+# and resumed like the results (state / restore).
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from length_effects import SIM_KEY, SIM_ORDER
+from sim_reader import META_HEADER
+from sim_store import SCALE
+
+RELATIONS = ['cohort', 'rhyme', 'unrelated']
+
+
+# Record layout of one simulation
+# input: words in the lexicon, cycles, alignment labels, number of Luce k values,
+#        number of competitor trajectories
+def summaryDtype(words, cycles, labels, kValues, competitors):
+    alignment = np.dtype([('peak', np.int16, (words,)), ('peakCycle', np.int16, (words,)),
+                          ('target', np.int16, (cycles,)),
+                          ('top', np.int16, (2, cycles)), ('topWords', np.int32, (2, cycles)),
+                          ('competitors', np.int16, (competitors, cycles)),
+                          ('competitorWords', np.int32, (competitors,)),
+                          ('relations', np.float64, (len(RELATIONS), cycles)),
+                          ('lse', np.float64, (kValues, cycles))])
+    return np.dtype([('argmaxCopy', np.int8, (words,)), ('targetWord', np.int32),
+                     ('alignments', [(label, alignment) for label in labels])])
+
+
+def headerDtype(header):
+    return summaryDtype(len(header['lexicon']), header['cycles'], [a[0] for a in header['alignments']],
+                        len(header['lucekValues']), header['competitors'])
+
+
+# int16 copy of activation values (they have four decimals, so this is lossless)
+def toFixed(values):
+    return np.rint(np.asarray(values) * SCALE).astype(np.int16)
+
+
+def fromFixed(values):
+    return np.asarray(values, dtype=np.float64) / SCALE
+
+
+# Appends summary records to a summary directory
+class SummaryWriter:
+    def __init__(self, path, settings):
+        self.path = path
+        self.settings = settings
+        self.binfile = os.path.join(path, 'summaries.bin')
+        self.indexfile = os.path.join(path, 'index.csv')
+        self.headerfile = os.path.join(path, 'summary.json')
+        self.bin = None
+        self.index = None
+        self.count = 0
+
+    # Removes the summaries of an earlier run
+    def reset(self):
+        self.close()
+        for path in (self.binfile, self.indexfile, self.headerfile):
+            if os.path.exists(path):
+                os.remove(path)
+        self.count = 0
+
+    def exists(self):
+        return os.path.exists(self.headerfile)
+
+    def open(self):
+        if self.bin is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.bin = open(self.binfile, 'ab')
+            self.index = open(self.indexfile, 'a')
+            if self.index.tell() == 0:
+                self.index.write(','.join(['sim'] + META_HEADER) + '\n')
+
+    # input: simulation metadata, the simulation's words, cycles and its record (bytes)
+    def add(self, meta, words, cycles, record):
+        if not os.path.exists(self.headerfile):
+            os.makedirs(self.path, exist_ok=True)
+            header = dict(self.settings, cycles=cycles, lexicon=list(words))
+            with open(self.headerfile, 'w') as f:
+                json.dump(header, f)
+        self.open()
+        self.bin.write(record)
+        row = pd.DataFrame([[self.count] + [meta[h] for h in META_HEADER]], columns=['sim'] + META_HEADER)
+        row.to_csv(self.index, header=False, index=False)
+        self.count = self.count + 1
+
+    def close(self):
+        if self.bin is not None:
+            self.bin.close()
+            self.index.close()
+            self.bin = None
+            self.index = None
+
+    # Flushes and fsyncs the summaries
+    # output: number of records written
+    def state(self):
+        if self.bin is not None:
+            for f in (self.bin, self.index):
+                f.flush()
+                os.fsync(f.fileno())
+        return self.count
+
+    # Cuts the summaries back to a state(); with None (no checkpoint) to the last
+    # complete record
+    def restore(self, state):
+        self.close()
+        if not self.exists():
+            self.count = 0
+            return
+        with open(self.headerfile) as f:
+            header = json.load(f)
+        if {k: v for k, v in header.items() if k not in ('cycles', 'lexicon')} != self.settings:
+            raise ValueError('summary ' + self.path + ' was written with other settings')
+        itemsize = headerDtype(header).itemsize
+        records = os.path.getsize(self.binfile) // itemsize if os.path.exists(self.binfile) else 0
+        if os.path.exists(self.indexfile):
+            records = min(records, len(SimSummary.readIndex(self.indexfile)))
+        self.count = records if state is None else min(state, records)
+        if os.path.exists(self.binfile):
+            os.truncate(self.binfile, self.count * itemsize)
+        if os.path.exists(self.indexfile):
+            with open(self.indexfile, 'rb+') as f:
+                lines = f.read().split(b'\n')
+                f.seek(0)
+                f.truncate()
+                f.write(b'\n'.join(lines[:self.count + 1]) + b'\n')
+
+
+# Read-only view of a summary directory, in the same way SimStore is one of a store
+class SimSummary:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'summary.json')) as f:
+            self.header = json.load(f)
+        self.dtype = headerDtype(self.header)
+        self.index = self.readIndex(os.path.join(path, 'index.csv'))
+        self.words = np.array(self.header['lexicon'], dtype=object)
+        self.cycles = self.header['cycles']
+        self.labels = [a[0] for a in self.header['alignments']]
+        self.open()
+
+    @staticmethod
+    def readIndex(path):
+        return pd.read_csv(path, dtype={'Target': str, 'Fullstring': str}, keep_default_na=False)
+
+    def open(self):
+        records = os.path.getsize(os.path.join(self.path, 'summaries.bin')) // self.dtype.itemsize
+        self.simulations = min(records, len(self.index))
+        self.data = np.memmap(os.path.join(self.path, 'summaries.bin'), dtype=self.dtype, mode='r',
+                              shape=(self.simulations,))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return self.simulations
+
+    # Metadata of one simulation, as sim_reader.parseMeta returns it
+    def meta(self, i):
+        row = self.index.iloc[i]
+        return {h: (row[h].item() if hasattr(row[h], 'item') else row[h]) for h in META_HEADER}
+
+    # Record of one simulation (a copy, so it outlives the memmap)
+    def record(self, i):
+        return np.array(self.data[i])
+
+    # Positions of the simulations matching the given combos and/or targets
+    def select(self, param_combos=None, targets=None):
+        index = self.index.iloc[:len(self)]
+        keep = np.ones(len(self), dtype=bool)
+        if param_combos is not None:
+            keep &= index['param_combo'].isin(param_combos).to_numpy()
+        if targets is not None:
+            keep &= index['Target'].isin(targets).to_numpy()
+        return np.flatnonzero(keep)
+
+
+# Merges shard summaries (same settings and lexicon) into one summary directory,
+# keeping each simulation (SIM_KEY) once and ordering as shards.mergeResults does
+def mergeSummaries(paths, outpath):
+    summaries = [SimSummary(path) for path in paths if os.path.exists(os.path.join(path, 'summary.json'))]
+    if not summaries:
+        return 0
+    header = summaries[0].header
+    for summary in summaries[1:]:
+        if summary.header != header:
+            raise ValueError('summaries ' + summary.path + ' and ' + summaries[0].path + ' do not match')
+
+    frames = [summary.index.iloc[:len(summary)].assign(summary=n) for n, summary in enumerate(summaries)]
+    indexDF = pd.concat(frames, ignore_index=True).drop_duplicates(SIM_KEY)
+    indexDF = indexDF.sort_values(SIM_ORDER, kind='stable')
+
+    writer = SummaryWriter(outpath, {k: v for k, v in header.items() if k not in ('cycles', 'lexicon')})
+    writer.reset()
+    for _, row in indexDF.iterrows():
+        meta = {h: (row[h].item() if hasattr(row[h], 'item') else row[h]) for h in META_HEADER}
+        writer.add(meta, header['lexicon'], header['cycles'], summaries[row['summary']].data[row['sim']].tobytes())
+    writer.close()
+    return writer.count
@@ -6,6 +6,8 @@
 #             added class to do command line arguments
 
 # v5_sg_analysis_jm.py
+import copy
+import cProfile
 import pickle
 import sys
 
@@ -13,19 +15,156 @@ import numpy as np
 import pandas
 import pandas as pd
 import os
-import math
 import argparse
+import multiprocessing
 import time
 import psutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import length_effects
+import shards
+from length_effects import LengthEffects, loadLengths
+from metrics import MetricsLog, Stopwatch
+from results_db import ResultsDB, importLengthEffects, importResults
+from results_sink import ResultsSink
+from run_cache import RunCache
+from sim_index import IndexWriter, SimIndex, openForIndexing
+from sim_reader import META_HEADER, isStream, iterChunks, openSimFile, parseBlock, parseMeta, prefetch
+from sim_store import SimStore
+from sim_summary import SimSummary, SummaryWriter, fromFixed, mergeSummaries, summaryDtype, toFixed
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rhymes-cohorts'))
+import relation_table  # noqa: E402
 # from csv import reader
 # from csv import writer
 
-import warnings
 
-warnings.simplefilter(action='ignore', category=pd.errors.PerformanceWarning)
-word_tracker = 0
-length_effects_DF_list = []
-length_effects_param_combo_DF = pd.DataFrame()
+# Cohorts and rhymes of every target, loaded once from a relation table or the
+# rhymes/cohorts pickle (rhymes-cohorts.py). Once the word order of the simulations
+# is known each target is mapped to integer columns, so a lookup is two small index
+# arrays. A relation table is memory-mapped, so only the rows of targets that are
+# simulated are read
+class RelationIndex:
+    def __init__(self, path):
+        self.table = None
+        self.lists = {}
+        if relation_table.isTable(path):
+            self.table = relation_table.RelationTable(path)
+        else:
+            with open(path, 'rb') as f:
+                cohorts_rhymesDF = pickle.load(f)
+            for phon, cohorts, rhymes in zip(cohorts_rhymesDF['Phonology'], cohorts_rhymesDF['cohorts'],
+                                             cohorts_rhymesDF['rhymes']):
+                self.lists.setdefault(phon, (cohorts, rhymes))
+        self.words = None
+        self.columns = {}
+        self.colOf = None
+
+    # Maps every target's cohorts and rhymes to columns of the given word order
+    # (for a table, table ids to columns, -1 for words the simulations lack)
+    def index(self, words):
+        wordCol = {word: col for col, word in enumerate(words)}
+        self.columns = {}
+        if self.table is not None:
+            self.colOf = np.array([wordCol.get(word, -1) for word in self.table.words.tolist()], dtype=np.int64)
+        for phon, (cohorts, rhymes) in self.lists.items():
+            self.columns[phon] = (np.array([wordCol[w] for w in cohorts if w in wordCol], dtype=np.int64),
+                                  np.array([wordCol[w] for w in rhymes if w in wordCol], dtype=np.int64))
+        self.words = words
+
+    # Columns of a target's cohorts and rhymes (None for unknown targets)
+    def lookup(self, thetarget):
+        if self.table is None:
+            return self.columns.get(thetarget)
+        if thetarget not in self.columns:
+            i = self.table.ids().get(thetarget)
+            if i is None:
+                self.columns[thetarget] = None
+            else:
+                cols = [self.colOf[self.table[name].row(i)] for name in ('cohorts', 'rhymes')]
+                self.columns[thetarget] = tuple(c[c >= 0] for c in cols)
+        return self.columns[thetarget]
+
+    # input: target and the simulation's words (lexicon order)
+    # output: boolean cohort and rhyme masks over the words (empty for unknown targets)
+    def masks(self, thetarget, words):
+        if self.words is None or not np.array_equal(self.words, words):
+            self.index(words)
+        isCohort = np.zeros(len(words), dtype=bool)
+        isRhyme = np.zeros(len(words), dtype=bool)
+        found = self.lookup(thetarget)
+        if found is not None:
+            cohortCols, rhymeCols = found
+            isCohort[cohortCols] = True
+            isRhyme[rhymeCols] = True
+        return isCohort, isRhyme
+
+
+# Accuracy and RT per param_combo x threshold (x Luce k), accumulated one
+# simulation at a time. Simulations come grouped by param_combo, so a
+# combination is written out as soon as the next one starts and memory stays
+# bounded by one (k values x thresholds) grid
+class SweepTable:
+    def __init__(self, path, thresholds, lucekValues=None):
+        self.path = path
+        self.thresholds = thresholds
+        self.lucekValues = lucekValues
+        self.combo = None
+        self.header = True
+
+    # input: simulation metadata, (k, thresholds) recognized and RT arrays
+    def add(self, meta, recognized, rt):
+        if self.combo is not None and meta['param_combo'] != self.combo['meta']['param_combo']:
+            self.write()
+        if self.combo is None:
+            self.combo = {'meta': meta, 'n': 0, 'recognized': np.zeros(rt.shape), 'rtSum': np.zeros(rt.shape)}
+        self.combo['n'] = self.combo['n'] + 1
+        self.combo['recognized'] += recognized
+        self.combo['rtSum'] += np.where(recognized > 0, rt, 0)
+
+    # writes the current param_combo: accuracy, and mean RT of the recognized simulations
+    def write(self):
+        combo = self.combo
+        meta = combo['meta']
+        nK, nT = combo['rtSum'].shape
+        with np.errstate(invalid='ignore', divide='ignore'):
+            meanRT = combo['rtSum'] / combo['recognized']
+        sweepDF = pd.DataFrame({h: meta[h] for h in META_HEADER[2:]}, index=range(nK * nT))
+        if self.lucekValues is not None:
+            sweepDF['lucek'] = np.repeat(self.lucekValues, nT)
+        sweepDF['thresh'] = np.tile(self.thresholds, nK)
+        sweepDF['n'] = combo['n']
+        sweepDF['accuracy'] = (combo['recognized'] / combo['n']).ravel()
+        sweepDF['mean_RT'] = meanRT.ravel()
+        sweepDF.to_csv(self.path, mode='w' if self.header else 'a', header=self.header, na_rep='nan', index=False)
+        self.header = False
+        self.combo = None
+
+    def close(self):
+        if self.combo is not None:
+            self.write()
+
+
+# Columns of the --top competitors table, after the results' parameters and Target
+TOP_HEADER = ['alignment', 'rank', 'word', 'peak', 'peak_cycle']
+
+
+# Positions of the k largest values, largest first and ties in position order
+# (the same as np.argsort(-values, kind='stable')[:k]). Only the k selected values
+# are sorted: the k-th largest comes from a partial selection (np.partition)
+# input: 1-d array, k
+# output: int array of at most k positions
+def topK(values, k):
+    n = len(values)
+    if k >= n:
+        return np.argsort(-values, kind='stable')
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    kth = np.partition(values, n - k)[n - k]
+    above = np.flatnonzero(values > kth)
+    cols = np.concatenate((above, np.flatnonzero(values == kth)[:k - len(above)]))
+    return cols[np.argsort(-values[cols], kind='stable')]
 
 
 # Class to store variables (command line input)
@@ -34,83 +173,154 @@ class Analysis:
         self.File = data["File"]
         self.alignment = data["alignment"]  # default = post-hoc
         self.specified = data["specified"]  # default = 4
+        self.alignmentOutput = data["alignmentOutput"]  # default = files
+        self.alignments = self.expandAlignments(self.alignment, self.specified)
         self.lucek = data["lucek"]  # default = 13
         self.lastSlice = data["lastSlice"]  # default = 12
         self.outfile = data["outfile"]  # default = outfile
+        self.format = data["format"]  # default = csv
+        self.batchSize = data["batchSize"]  # default = 500
+        self.flushInterval = data["flushInterval"]  # default = 60 seconds
         self.respProb = data["respProb"]  # default = FALSE
-        self.thresh = 0.41  # default = 0.4
-        # self.thresh     = data["thresh"]       # default = 0.4
-        # self.topSlices = data["topSlices"]  # default = 50
-        self.topSlices = 14678  # default = 50 INCLUDE SILENCE
-        #self.topSlices = 400  # default = 50 INCLUDE SILENCE
-        # self.words      = data["words"]        # default = 901
-        # self.words      = 1162        # default = 901
-        self.words = 14679  # default = 901
+        self.thresh = data["thresh"]  # default = 0.41
+        self.topSlices = data["topSlices"]  # default = 14678 INCLUDE SILENCE
+        self.words = data["words"]  # default = 901
         self.cycles = data["cycles"]  # default = 100
         self.combinations = 729
+        self.workers = data["workers"]  # default = 1
+        self.resume = data["resume"]  # default = FALSE
+        self.checkpointEvery = data["checkpointEvery"]  # default = 100
+        self.name = shards.inputName(self.File)  # File without wildcards
+        self.lexiconFile = data["lexicon"]
+        self.lengthEffectsFiles(loadLengths(self.lexiconFile))  # default = data/lemmalex (Length)
+        self.relationsFile = data["relations"]
+        self.relations = RelationIndex(self.relationsFile)  # default = ./flex2_rhymes_cohorts.pickle
+        self.sweep = data["sweep"]  # default = FALSE
+        self.thresholds = np.round(np.arange(*data["thresholds"]), 6)  # default = .1 to .99 by .01
+        self.lucekValues = data["lucekValues"] or [self.lucek]  # default = lucek
+        self.combos = data["combos"]  # default = all
+        self.targets = data["targets"]  # default = all
+        self.store = None
+        self.summary = data["summary"]  # default = none
+        self.competitors = data["competitors"]  # default = 10
+        self.top = data["top"]  # default = none
+        self.cache = data["cache"]  # default = none
+        self.dbFile = data["db"]  # default = none
+        self.writeIndex = data["index"]  # default = FALSE
+        self.summaryIn = None
+        self.sweepfile = os.path.splitext(str(self.outfile))[0] + '_sweep.csv'
+        self.metricsfile = os.path.splitext(str(self.outfile))[0] + '_metrics.jsonl'
+        self.profileEvery = data["profileEvery"]  # default = never
+        self.progress = 0.0
+        self.readTime = 0.0
+
+    # The checkpoint and the length-effects files are named after the results file
+    # (without its extension), so runs over the same input with different outfiles
+    # never share them. Call again after changing outfile
+    # input: dict of phonology -> length
+    def lengthEffectsFiles(self, lengths):
+        base = os.path.splitext(str(self.outfile))[0]
+        self.checkpoint = base + '_length_effects.ckpt'
+        self.lengthEffects = LengthEffects(base + '_length_effects', lengths, targets=self.words)
+
+    # Every word-unit selection to compute in one pass: 'all' is post-hoc, ad-hoc
+    # and specified, and specified gives one selection per --specified copy
+    # input: alignment name(s), copy number(s)
+    # output: list of (label, alignment, copy), e.g. ('specified-4', 'specified', 4)
+    def expandAlignments(self, alignment, specified):
+        if isinstance(alignment, str):
+            alignment = [alignment]
+        if isinstance(specified, int):
+            specified = [specified]
+        alignments = []
+        for name in alignment:
+            for expanded in (['post-hoc', 'ad-hoc', 'specified'] if name == 'all' else [name]):
+                if expanded == 'specified':
+                    alignments += [('specified-' + str(copy), expanded, copy) for copy in specified]
+                else:
+                    alignments.append((expanded, expanded, None))
+        return list(dict((a[0], a) for a in alignments).values())
 
     ###########################################################
     # PART 1: Calculating response probabilities
 
-    # Numerator value of the Luce Choice Rule
-    def numerator(self, val):
-        return math.exp(self.lucek * val)
+    # Views a chunk as one words x cycles x copies array. tracejs writes rows
+    # word-major and then cycle-major (serializeData), so every chunk is a fixed
+    # shape block and we can reshape instead of masking the chunk once per word
+    # input: dataframe of one simulation
+    # output: array of words (lexicon order) and a (words, cycles, 33) array
+    def chunkToArray(self, dataDF):
+        copies = dataDF.loc[:, list(range(1, 34))].to_numpy(dtype=np.float64)
+        # cycles: the rows of the first word
+        firstCycles = np.flatnonzero(dataDF['Cycle'].to_numpy() == 0)
+        cycles = int(firstCycles[1]) if len(firstCycles) > 1 else len(dataDF)
+        nwords = len(dataDF) // cycles
+        if nwords * cycles != len(dataDF):
+            raise ValueError('chunk of ' + str(len(dataDF)) + ' rows is not a multiple of ' +
+                             str(cycles) + ' cycles')
+
+        labels = dataDF['Word'].to_numpy().reshape(nwords, cycles)
+        words = labels[:, 0]
+        if not (labels == words[:, None]).all():
+            raise ValueError('chunk rows are not ordered word-major, then cycle-major')
+
+        return words, copies.reshape(nwords, cycles, copies.shape[1])
 
     # Selects one copy from each word
-    # input: dataframe of one word in the simulation
-    #   Columns: copy of word   Rows: timestep
-    # output: returns a list of activation values for the word at each timestep
-    def selectWordUnits(self, df):
-        # print('selectWordUnits; alignment = ' + str(self.alignment))
-        # print('df\n', df.head())
-        df = df.drop(
-            columns=["Cycle", 'Fullstring', "alpha_if", "alpha_pw", 'alpha_fp', "alpha_wp", "gamma_f", "gamma_p",
-                     "gamma_w", "param_combo", "Target", "Word"])
-        # df = (df.drop(columns=["Cycle", "Fullstring", "Target", "Feedback", "Noise", "Word"]))
-        # print('df after drop\n', df.head())
-
+    # input: (words, cycles, copies) array of one simulation, alignment and the
+    #        copy number for specified alignment
+    # output: (cycles, words) array of activation values for each word at each timestep
+    def selectWordUnits(self, acts, alignment, specified=None):
         # copy = specified
-        if self.alignment == "specified":
-            # print("specified")
-            df = df.loc[:, [self.specified]].squeeze()
+        if alignment == "specified":
+            selected = acts[:, :, specified - 1]
 
-        # copy = max activated
-        elif self.alignment == "post-hoc":
-            # print("post")
-            maxValCol = pd.to_numeric(df.stack()).idxmax()[1]
-            df = df.loc[:, [maxValCol]].squeeze()
+        # copy = max activated (first max over cycles x copies, as idxmax on the stacked frame)
+        elif alignment == "post-hoc":
+            maxCopy = acts.reshape(acts.shape[0], -1).argmax(axis=1) % acts.shape[2]
+            selected = np.take_along_axis(acts, maxCopy[:, None, None], axis=2)[:, :, 0]
 
         # copy = max at each timestep (not same copy throughout)
-        elif self.alignment == "ad-hoc":
-            # print("ad-hoc")
-            df = df.max(axis=1)
-
-        # print("select word units\n",df.head())
-        return list(df)
-
-    # Calculates the response probability
-    # input: dataframe of the activation values 
-    # output: dataframe of the response probabilities 
-    def calcRespProb(self, df):
-        df = df.applymap(self.numerator)
-        df = df.div(df.sum(axis=1), axis=0)
-        return df
-
-    # input: data(frame) and target
+        elif alignment == "ad-hoc":
+            selected = acts.max(axis=2)
+
+        return selected.T
+
+    # Calculates the response probability with the Luce choice rule,
+    # exp(k * a) / sum over words of exp(k * a). The largest k * a of each cycle is
+    # subtracted first (log-sum-exp), so large k cannot overflow
+    # input: (..., cycles, words) array of the activation values (one simulation or
+    #        a batch), Luce k (default lucek; an array broadcasts against data)
+    # output: array of the response probabilities, same shape
+    def calcRespProb(self, data, lucek=None):
+        if lucek is None:
+            lucek = self.lucek
+        data = lucek * data
+        data = np.exp(data - data.max(axis=-1, keepdims=True))
+        return data / data.sum(axis=-1, keepdims=True)
+
+    # input: (cycles, words) array and column index of the target
     # output: returns accuracy and RT for one simulation
     def getAccRT(self, data, trg):
 
-        # print(data)
+        # get the max of the data excluding the most activated word
+        colMax = data.max(axis=0)
+        others_max = float(np.delete(colMax, colMax.argmax()).max())
+        return self.scoreAccRT(data[:, trg], others_max)
+
+    # input: target trajectory and the peak of the strongest other word (the
+    #        most activated word excluded)
+    # output: accuracy and RT
+    def scoreAccRT(self, trgData, others_max):
+
         # test if target exceeds threshold; this is the first
         # condition that must be true for a correct simulation
-        if data[trg].max() > self.thresh:
-            print("MAX", data[trg].max())
-            trg_exceeds = data[data[trg].gt(self.thresh)].index[0]
+        trgMax = float(trgData.max())
+        if trgMax > self.thresh:
+            print("MAX", trgMax)
+            trg_exceeds = int(np.argmax(trgData > self.thresh))
         else:
-            trg_exceeds = np.NaN
-
-        # get the max of the data excluding the target
-        others_max = data.max().drop(pd.to_numeric(data.max()).idxmax()).max()
+            trg_exceeds = np.nan
 
         # now check if that max is greater than the thresh; if so,
         # this will be an error
@@ -124,309 +334,781 @@ class Analysis:
         else:
             acc = 0
 
-        return [acc, trg_exceeds, data[trg].max(), others_max]
+        return [acc, trg_exceeds, trgMax, others_max]
+
+    # getAccRT for a whole grid of thresholds (and Luce k values when respProb is
+    # on) at once. A simulation is recognized when the target exceeds the
+    # threshold after cycle 0 and the strongest other word stays below it (if the
+    # target is not the most activated word, getAccRT's others_max is at least the
+    # target's max, so that is the same test), so all we need is the target
+    # trajectory and the peak of the strongest competitor
+    # input: (cycles, words) array with the target in column 0
+    # output: (k values, thresholds) arrays of recognized (0/1) and RT (NaN if never exceeded)
+    def sweepAccRT(self, data):
+        if self.respProb:
+            rps = self.calcRespProb(data, np.asarray(self.lucekValues, dtype=np.float64)[:, None, None])
+        else:
+            rps = data[None]
+        return self.sweepGrid(rps[:, :, 0], rps[:, :, 1:].max(axis=(1, 2)))
+
+    # input: (k values, cycles) target trajectories and (k values,) peaks of the
+    #        strongest other word
+    # output: same as sweepAccRT
+    def sweepGrid(self, trgData, othersMax):
+        above = trgData[:, None, :] > self.thresholds[None, :, None]
+        rt = np.where(above.any(axis=2), above.argmax(axis=2), np.nan)
+        recognized = (rt > 0) & (othersMax[:, None] < self.thresholds[None, :])
+        return recognized.astype(np.int64), rt
+
+    # Peak value and time of the mean trajectory over some columns
+    # input: (cycles, words) array and boolean column mask
+    # output: peak value and peak cycle (NaN if no column is selected)
+    def peakOfMean(self, data, mask):
+        if not mask.any():
+            return np.nan, np.nan
+        return self.peakOf(data[:, mask].mean(axis=1))
+
+    # Peak value and time of a trajectory (NaN for an all-NaN one)
+    def peakOf(self, meanData):
+        if np.isnan(meanData).all():
+            return np.nan, np.nan
+        return float(meanData.max()), int(meanData.argmax())
 
     # Processes a chunk (all data relevant for 1 simulation)
     # One chunk = data for all words, given 1 target
     # Input: dataframe
     # Output: accuracy and RT for this simulation
     def processChunk(self, dataDF):
+        words, acts = self.chunkToArray(dataDF)
+        meta = {h: dataDF[h].iloc[0] for h in META_HEADER}
+        return self.processActivations(meta, words, acts)
 
-        # dataDF.head()
-
-        # first we get rid of characters that can be problematic
-        # dataDF.Word = dataDF.Word.apply(lambda x: x.replace('-','Q'))
-        # dataDF.Word = dataDF.Word.apply(lambda x: x.replace('S','h'))
-        # dataDF.Word = dataDF.Word.apply(lambda x: x.replace('^','x'))
-        #
-        # dataDF.Target = dataDF.Target.apply(lambda x: x.replace('-','Q'))
-        # dataDF.Target = dataDF.Target.apply(lambda x: x.replace('S','h'))
-        # dataDF.Target = dataDF.Target.apply(lambda x: x.replace('^','x'))
-
-        # WE DONT NEED TO DO RTHAT, RIGHT ?
-
-        pd.set_option('display.max_columns', None)
-        pd.set_option('display.width', 1000)
-        #print(dataDF)
-        #sys.exit()
-        # get the word list
-        #lexicon = dataDF.Target.unique()
-        lexicon = dataDF.Word.unique()
-        # print("lexicon", lexicon)
-
-        # define an empty data frame
-        outputDF = pd.DataFrame()
-
-        # define a couple variables relevant for progerss reports
-        # lexlen = len(lexicon)
-        # atword = 0
-
-        # for each word in dataDF select one copy for each word, based on
-        # alignment (this happens in selectWordUnits)
-        # print(dataDF.head())
-        # dataDF = inputDF
-        for word in lexicon:
-            # atword = atword + 1
-            # print('\t\t' + str(atword) + ' of ' + str(lexlen) + '\t' + str(word) + '                    ', end = '\r')
-            copy = self.selectWordUnits(dataDF.loc[dataDF["Word"] == word])
-            outputDF[word] = copy
-            
-        #print(lexicon)
-        #print(outputDF.columns)
-        #print(outputDF.head())
-
-        # drop the silence phoneme
-        # outputDF = outputDF.drop(columns=["-"])
-
-        # put the target data into its own data frame. We do this because sometimes,
-        # especially when noise is high, the target might not make it into the topSlices,
-        # which leads to missing key errors
-        thetarget = dataDF['Target'].iloc[0]
-        # print(thetarget)
-        # print(outputDF.keys())
-        # print('ABOUT TO GET TARGETDF for TARGET ' + thetarget)
-        # print(outputDF)
-        targetDF = outputDF[thetarget]
-        # print(targetDF.head())
-        # print(targetDF.keys())
+    # Input: simulation metadata, words in lexicon order and their (words, cycles, copies) activations
+    # Output: accuracy and RT for this simulation, one list per alignment
+    def processActivations(self, meta, words, acts):
+        accrts, targetData, sweep, watch, summary, top = self.analyzeSimulation(meta['Target'], words, acts)
 
-        # now let's select the topSlices - 1 other items to include
-        otherDF = outputDF.drop(columns=[thetarget])
-        topIndex = otherDF.max().sort_values(ascending=False).index[:(self.topSlices - 1)]
-        otherDF = otherDF[topIndex]
+        # length-effects
+        self.lengthEffects.add(meta, meta['Target'], targetData)
+        return accrts
+
+    # Parses and analyzes one block of rows (one simulation, see sim_reader)
+    # Output: same as analyzeSimulation
+    def analyzeBlock(self, block):
+        watch = Stopwatch()
+        with watch.stage('parse'):
+            sim = parseBlock(block)
+        return self.analyzeSimulation(sim.meta['Target'], sim.words, sim.acts, watch)
+
+    # Analyzes one simulation of the store (see sim_store)
+    # Output: same as analyzeSimulation
+    def analyzeStored(self, i):
+        watch = Stopwatch()
+        with watch.stage('read'):
+            sim = self.store.simulation(i)
+        return self.analyzeSimulation(sim.meta['Target'], sim.words, sim.acts, watch)
+
+    # Analyzes one simulation from its summary (see sim_summary)
+    # Output: same as analyzeSimulation
+    def analyzeSummary(self, i):
+        watch = Stopwatch()
+        with watch.stage('read'):
+            record = self.summaryIn.record(i)
+        trgCol = int(record['targetWord'])
+        watch.rows = len(self.summaryIn.words) * self.summaryIn.cycles
+        accrts = []
+        top = []
+        for label, alignment, copy in self.alignments:
+            summary = record['alignments'][label]
+            with watch.stage('accrt'):
+                accrt, trgData, sweep = self.evaluateSummary(summary, trgCol)
+            if self.top:
+                with watch.stage('select'):
+                    peak = fromFixed(summary['peak'])
+                    cols = self.competitorsOf(peak, trgCol)
+                    top.append((self.summaryIn.words[cols], peak[cols], summary['peakCycle'][cols]))
+            if not accrts:
+                targetData, firstSweep = trgData, sweep
+            accrts.append(accrt)
+        return accrts, targetData, firstSweep, watch, None, top if self.top else None
+
+    # Runs one analyze method; every profileEvery-th simulation runs under
+    # cProfile and its stats go next to the metrics file (<metrics>_<n>.prof)
+    # Input: analyze method name, block or store position, simulation number
+    def analyzeItem(self, analyze, item, n):
+        if self.profileEvery and n % self.profileEvery == 0:
+            profile = cProfile.Profile()
+            result = profile.runcall(getattr(self, analyze), item)
+            profile.dump_stats(os.path.splitext(self.metricsfile)[0] + '_' + str(n) + '.prof')
+            return result
+        return getattr(self, analyze)(item)
+
+    # Same as processActivations, but leaves the length-effects bookkeeping to the
+    # caller, so it can run in a worker process. Every alignment is computed from
+    # the same activations; the target trajectory and the sweep are those of the
+    # first alignment
+    # Output: accuracy and RT for this simulation (one list per alignment), the
+    # target's activation at each cycle, the sweep arrays, the Stopwatch with the
+    # time spent in each stage and the simulation's rows (see metrics.py), with --summary the words, cycles and the summary record (bytes)
+    # and with --top the strongest competitors (see competitorsOf) of every alignment
+    def analyzeSimulation(self, thetarget, words, acts, watch=None):
+        if watch is None:
+            watch = Stopwatch()
+        watch.rows = acts.shape[0] * acts.shape[1]
+        trgCol = np.flatnonzero(words == thetarget)
+        if len(trgCol) == 0:
+            raise KeyError(thetarget)
+        trgCol = trgCol[0]
+
+        # cohorts and rhymes of this target, as masks over all words
+        with watch.stage('relations'):
+            isCohort, isRhyme = self.relations.masks(thetarget, words)
+
+        if self.summary:
+            record = np.zeros((), dtype=self.summaryDtype(len(words), acts.shape[1]))
+            record['targetWord'] = trgCol
+            with watch.stage('summary'):
+                record['argmaxCopy'] = acts.reshape(acts.shape[0], -1).argmax(axis=1) % acts.shape[2] + 1
+
+        accrts = []
+        top = []
+        for label, alignment, copy in self.alignments:
+            # for each word select one copy, based on alignment (this happens in
+            # selectWordUnits); one column per word
+            with watch.stage('select'):
+                outputData = self.selectWordUnits(acts, alignment, copy)
+                peak = outputData.max(axis=0)
+            accrt, evalCols, evalData = self.evaluate(outputData, peak, trgCol, isCohort, isRhyme, watch)
+            if self.top:
+                with watch.stage('select'):
+                    cols = self.competitorsOf(peak, trgCol)
+                    top.append((words[cols], peak[cols], outputData[:, cols].argmax(axis=0)))
+            if not accrts:
+                targetData = evalData[:, 0]
+                with watch.stage('accrt'):
+                    sweep = self.sweepAccRT(evalData) if self.sweep else None
+            if self.summary:
+                with watch.stage('summary'):
+                    self.summarize(record['alignments'][label], outputData, peak, evalCols, evalData, isCohort,
+                                   isRhyme)
+            accrts.append(accrt)
+        summary = (words, acts.shape[1], record.tobytes()) if self.summary else None
+        return accrts, targetData, sweep, watch, summary, top if self.top else None
+
+    # Accuracy, RT and relation peaks for one word-unit selection
+    # input: (cycles, words) array, each word's peak, target column, cohort and
+    #        rhyme masks over the words, Stopwatch
+    # output: accuracy and RT list, the eval columns and the (cycles, topSlices)
+    # array with the target first
+    def evaluate(self, outputData, peak, trgCol, isCohort, isRhyme, watch):
+        with watch.stage('select'):
+            evalCols, evalData = self.topSlicesOf(outputData, peak, trgCol)
+
+        # if want RPs, recognition and RT are scored on the response
+        # probabilities (softmax over the eval columns) rather than activations
+        with watch.stage('accrt'):
+            if self.respProb:
+                accrt = self.getAccRT(self.calcRespProb(evalData), 0)
+            else:
+                accrt = self.getAccRT(evalData, 0)
 
-        # now let's concatenate them back together
-        evalDF = pd.concat([targetDF, otherDF], axis=1)
-        evalDF.columns.values[0] = thetarget
-        # print(evalDF)
-        # print(evalDF.columns)
-
-        accrt = self.getAccRT(evalDF, thetarget)
-        target_peakval = evalDF.iloc[:,0].max()
-        target_peaktime = evalDF.iloc[:,0].idxmax()
-        # print(target_peakval)
-        # print(target_peaktime)
-        # print(accrt)
+        with watch.stage('relations'):
+            # cohorts and rhymes restricted to the eval columns
+            isCohort = isCohort[evalCols]
+            isRhyme = isRhyme[evalCols]
 
-        # length-effects
-        global word_tracker
-        global length_effects_param_combo_DF
-        # take 5 steps of the target word activation at a time
-        # print(evalDF.iloc[::5,0])
-        # print(thetarget)
-        # print(word_tracker)
-
-        # print('IF STATEMENT')
-
-        if word_tracker < (self.words - 1):
-            length_effects_param_combo_DF.insert(word_tracker, thetarget, evalDF.iloc[::5, 0])
-            #print(length_effects_param_combo_DF)
-            word_tracker = word_tracker + 1
-            #print(word_tracker)
-            if word_tracker == (self.words - 1):
-                length_effects_DF_list.append(length_effects_param_combo_DF)
-                length_effects_param_combo_DF = pd.DataFrame()
-                word_tracker = 0
-        #
-        # if word_tracker >= (self.words-1):
-        #     print('ELSE STATEMENT')
-        #     print('THE TARGET', thetarget)
-        #     print('WORD TRACKER', word_tracker)
-        #     print('DF NOW')
-        #     print(length_effects_param_combo_DF)
-        #     word_tracker = 0
-        #     length_effects_DF_list.append(length_effects_param_combo_DF)
-        #     print('DF SHOULD BE NONE')
-        #     length_effects_param_combo_DF = pd.DataFrame()
-        #     print(length_effects_param_combo_DF)
-        #     length_effects_param_combo_DF.insert(word_tracker,thetarget,evalDF.iloc[::5,0])
-        #     print(length_effects_param_combo_DF)
-        #     word_tracker = word_tracker + 1
-        #     print(word_tracker)
-        # else:
-        #     length_effects_param_combo_DF.insert(word_tracker,thetarget,evalDF.iloc[::5,0])
-        #     print(length_effects_param_combo_DF)
-        #     word_tracker = word_tracker + 1
-        #     print(word_tracker)
-
-        #ok looks good ! now just remember to export the df_list
-
-        # print('exit')
-        # sys.exit()
-
-        # cohort_peakval = None
-        # cohort_peaktime = None
-        # rhyme_peakval = None
-        # rhyme_peaktime = None
-        # unrelated_peakval = None
-        # unrelated_peaktime = None
-
-        # if accrt[0] == 1:
-
-        # pandas.set_option('display.max_rows', None)
-        # print(thetarget)
-        # print(evalDF)
-
-        # crate dataframe with all words that reach a minimum threshold of -1 (all words do, but you can modify it)
-        compDF = evalDF[evalDF.columns[evalDF.max() >= -1]]
-
-        # import rhymes
-        with open(rhymes_cohorts_dir + 'flex2_rhymes_cohorts.pickle', 'rb') as f:
-            cohorts_rhymesDF = pickle.load(f)
-        # print(cohorts_rhymesDF)
-
-        # cohorts and rhymes
-        cohorts_rhymesDF = cohorts_rhymesDF.loc[cohorts_rhymesDF['Phonology']==thetarget]
-        # print(cohorts_rhymesDF)
-
-        # add rhymes and cohorts for test purposes
-        # cohorts_rhymesDF.at[0,'rhymes'] = ['siks','slEdIG']
-        # cohorts_rhymesDF.at[0,'cohorts'] = ['mltrt','xsAsxnet','YtInxrEri']
-        # print(cohorts_rhymesDF)
-
-        cohorts = cohorts_rhymesDF['cohorts'].tolist()[0]
-        rhymes = cohorts_rhymesDF['rhymes'].tolist()[0]
-        # print(cohorts)
-        # print(type(cohorts))
-        # print(rhymes)
-
-        # get all rhymes and cohorts that have an activation of > -1
-        meancohortDF = evalDF.loc[:,evalDF.columns.isin(cohorts)].mean(axis=1)
-        meanrhymeDF = evalDF.loc[:,evalDF.columns.isin(rhymes)].mean(axis=1)
-        meanunrelatedDF = evalDF.loc[:,~evalDF.columns.isin(cohorts) & ~evalDF.columns.isin(rhymes)].mean(axis=1)
-        # print(meanunrelatedDF)
-        # print('meancohortdf')
-        # print(meancohortDF)
-
-        cohort_peakval = meancohortDF.max()
-        cohort_peaktime = meancohortDF.idxmax()
-        rhyme_peakval = meanrhymeDF.max()
-        rhyme_peaktime = meanrhymeDF.idxmax()
-        unrelated_peakval = meanunrelatedDF.max()
-        unrelated_peaktime = meanunrelatedDF.idxmax()
-
-        #print(cohort_peakval,cohort_peaktime)
-        #print(rhyme_peakval,rhyme_peaktime)
-        #print(unrelated_peakval,unrelated_peaktime)
-
-
-
-            #if no rhymes are found, do not include them in the average
-            # sys.exit()
-
-        # if want RPs
-        # can leave that as false
-        # softmax mathematics
-        if self.respProb:
-            evalDF = self.calcRespProb(evalDF)
+            # mean rhyme, cohort and unrelated trajectories (as before, the target
+            # itself is counted with the unrelated words)
+            cohort_peakval, cohort_peaktime = self.peakOfMean(evalData, isCohort)
+            rhyme_peakval, rhyme_peaktime = self.peakOfMean(evalData, isRhyme)
+            unrelated_peakval, unrelated_peaktime = self.peakOfMean(evalData, ~isCohort & ~isRhyme)
 
         # now we get accuracy and RT
-        print(accrt)
         accrt = accrt + [cohort_peakval, cohort_peaktime, rhyme_peakval, rhyme_peaktime, unrelated_peakval, unrelated_peaktime]
         print(accrt)
-        return accrt
+        return accrt, evalCols, evalData
+
+    # Settings the summaries depend on (written to summary.json)
+    def summarySettings(self):
+        return {'alignments': [list(a) for a in self.alignments],
+                'topSlices': self.topSlices, 'lucekValues': self.kGrid(), 'competitors': self.competitors,
+                'relations': os.path.basename(os.path.normpath(str(self.relationsFile)))}
+
+    # Luce k values the summaries keep a log-sum-exp for: --lucek and --lucekValues
+    def kGrid(self):
+        return sorted(set([self.lucek] + list(self.lucekValues)))
+
+    def summaryDtype(self, words, cycles):
+        return summaryDtype(words, cycles, [a[0] for a in self.alignments], len(self.kGrid()),
+                            self.competitors)
+
+    # Fills one alignment of a summary record (see sim_summary): everything
+    # evaluate and sweepAccRT need, so they can be repeated without the activations
+    # input: record field of the alignment, (cycles, words) array,
+    #        each word's peak, eval columns, (cycles, topSlices) eval array,
+    #        cohort and rhyme masks over the words
+    def summarize(self, summary, outputData, peak, evalCols, evalData, isCohort, isRhyme):
+        summary['peak'] = toFixed(peak)
+        summary['peakCycle'] = outputData.argmax(axis=0)
+        summary['target'] = toFixed(evalData[:, 0])
+
+        # the two most activated eval words at every cycle, strongest first
+        top = np.argpartition(evalData, -2, axis=1)[:, :-3:-1]
+        topValues = np.take_along_axis(evalData, top, axis=1)
+        top = np.take_along_axis(top, np.argsort(-topValues, axis=1, kind='stable'), axis=1)
+        summary['top'] = toFixed(np.take_along_axis(evalData, top, axis=1).T)
+        summary['topWords'] = evalCols[top].T
+
+        # eval columns are ordered by peak, so the strongest competitors come right after the target
+        competitors = evalCols[1:self.competitors + 1]
+        summary['competitorWords'] = -1
+        summary['competitorWords'][:len(competitors)] = competitors
+        summary['competitors'][:len(competitors)] = toFixed(evalData[:, 1:self.competitors + 1].T)
+
+        isCohort = isCohort[evalCols]
+        isRhyme = isRhyme[evalCols]
+        for n, mask in enumerate([isCohort, isRhyme, ~isCohort & ~isRhyme]):
+            summary['relations'][n] = evalData[:, mask].mean(axis=1) if mask.any() else np.nan
+
+        for n, k in enumerate(self.kGrid()):
+            scaled = k * evalData
+            top = scaled.max(axis=1)
+            summary['lse'][n] = top + np.log(np.exp(scaled - top[:, None]).sum(axis=1))
+
+    # evaluate and sweepAccRT from one alignment of a summary record
+    # input: record field of the alignment, column of the target
+    # output: accuracy and RT list, the target trajectory and the sweep arrays
+    def evaluateSummary(self, summary, trgCol):
+        trgData = fromFixed(summary['target'])
+        top = fromFixed(summary['top'])
+        topWords = summary['topWords']
+        # strongest word other than the target at every cycle
+        othersData = np.where(topWords[0] != trgCol, top[0], top[1])
+
+        if self.respProb:
+            k = self.summaryIn.header['lucekValues']
+            lse = summary['lse'][[k.index(lucek) for lucek in [self.lucek] + list(self.lucekValues)]]
+            lucek = np.asarray([self.lucek] + list(self.lucekValues), dtype=np.float64)[:, None]
+            trgRP = np.exp(lucek * trgData - lse)
+            topRP = np.exp(lucek[:, :, None] * top[None] - lse[:, None, :])
+
+            # the strongest word's peak is left out of others_max: at every cycle
+            # that is the stronger of the two words that are not it
+            strongest = topWords[0, topRP[0, 0].argmax()]
+            othersMax = np.where(topWords[0] != strongest, topRP[0, 0], topRP[0, 1]).max()
+            accrt = self.scoreAccRT(trgRP[0], float(othersMax))
+            sweepTrg = trgRP[1:]
+            sweepOthers = np.exp(lucek[1:] * othersData - lse[1:]).max(axis=1)
+        else:
+            # peaks of the eval columns: the target and the topSlices - 1 strongest others
+            peak = fromFixed(summary['peak'])
+            # (only the two strongest others matter for the second-highest peak)
+            others = np.delete(peak, trgCol)
+            n = len(others) - min(2, self.topSlices - 1, len(others))
+            colMax = np.concatenate(([peak[trgCol]], np.partition(others, n)[n:]))
+            accrt = self.scoreAccRT(trgData, float(np.delete(colMax, colMax.argmax()).max()))
+            sweepTrg = trgData[None]
+            sweepOthers = othersData.max(keepdims=True)
+
+        peaks = []
+        for meanData in summary['relations']:
+            peaks += list(self.peakOf(meanData))
+        sweep = self.sweepGrid(sweepTrg, sweepOthers) if self.sweep else None
+        return accrt + peaks, trgData, sweep
+
+    # The --top strongest competitors: the words other than the target with the
+    # highest peaks, ranked as in topSlicesOf (ties go to the earlier word)
+    # input: each word's peak and the target column
+    # output: columns of the competitors, strongest first
+    def competitorsOf(self, peak, trgCol):
+        otherCols = np.delete(np.arange(len(peak)), trgCol)
+        return otherCols[topK(np.delete(peak, trgCol), self.top)]
+
+    # input: (cycles, words) array, each word's peak and the target column
+    # output: columns and (cycles, topSlices) array of the target and the topSlices - 1
+    # most activated other words
+    def topSlicesOf(self, outputData, peak, trgCol):
+
+        # put the target first. We do this because sometimes, especially when
+        # noise is high, the target might not make it into the topSlices
+        # now let's select the topSlices - 1 other items to include
+        otherCols = np.delete(np.arange(outputData.shape[1]), trgCol)
+        otherCols = otherCols[topK(np.delete(peak, trgCol), self.topSlices - 1)]
+
+        # now let's concatenate them back together
+        evalCols = np.concatenate(([trgCol], otherCols))
+        evalData = outputData[:, evalCols]
+        return evalCols, evalData
+
+    # Analyzes the input: one file, store or summary, or several shards. With --cache
+    # an identical earlier run is restored instead
+    def processFile(self):
+        files = shards.expandInputs(self.File)
+        if not files:
+            raise FileNotFoundError('no input matches ' + str(self.File))
+
+        # with --cache, the outputs of an identical earlier run are copied back, and a
+        # summary written from the same inputs is analyzed instead of the word data
+        # (run_cache.py). A stream cannot be hashed, and --summary must write its summary
+        cache = RunCache(self.cache) if self.cache and not any(isStream(path) for path in files) else None
+        if cache:
+            settings = self.cacheSettings(cache)
+            key = cache.key(files, settings)
+            if not self.summary and cache.restore(key, self.outputs()):
+                print('outputs of an identical run restored from ' + cache.entry(key))
+                if self.dbFile:
+                    self.importOutputs()
+                print('DONE.')
+                return
+            summary = None if self.summary else self.cachedSummary(cache, files)
+            if summary:
+                print('analyzing the summary ' + summary + ' of the same input')
+                files = [summary]
+
+        # several inputs (a glob pattern or a directory of shards) are analyzed
+        # shard by shard and merged
+        if len(files) > 1:
+            self.processShards(files)
+            if self.dbFile:
+                self.importOutputs()
+        else:
+            self.File = files[0]
+            self.analyzeFile()
+
+        if cache:
+            cache.save(key, settings, self.outputs())
+            if self.summary:
+                cache.addSummary(files, self.summary, self.summaryCacheSettings(cache))
 
     # Here, we are going to read in an input gzip'd CSV in chunks that are based
-    # on lexicon size and cycles per simulation -- simsize tells us how many
-    # lines there are per simulation. Then we will append to a data file (we are
+    # on lexicon size and cycles per simulation -- sim_reader hands us one
+    # words x cycles x copies array per simulation. Then we will append to a data file (we are
     # minimizing memory and possibly sacrificing a little speed with the constant
     # file handling, but if we don't do this and it crashes late, we just lose
     # everything if we haven't written to a file).
-    def processFile(self):
+    def analyzeFile(self):
 
         # for progress reports
-        start_time = time.time()
-        atrow = 0
         atchunk = 0
 
-        # number of rows per simuliation
-        simsize = (self.words * self.cycles)
-
         # define header fields
         resultsHeader = ['alpha_if', 'alpha_pw', 'alpha_fp', 'alpha_wp', "gamma_f", "gamma_p", "gamma_w", "param_combo",
                          "Target", "Recognized", "RT", "max", "others_max", "cohort_peak_val", "cohort_peak_time", "rhyme_peak_val", "rhyme_peak_time", "unrelated_peak_val", "unrelated_peak_time"]
-        # inputHeader = ["Cycle", "Fullstring", "Target", "Feedback", "Noise", "Word"] + list(range(1,34))
-        # 33, -x -, x, -0.3, 0.5, 0.025, 0.01, x, -0.3000, -0.3000, -0.3000, -0.2784
-
-        # inputHeader = ["Cycle", "Fullstring", "Target", "rest_w", "alpha_if", "alpha_pw", "alpha_wp", "Word"] + list(range(1,34))        inputHeader = ["Cycle", "Fullstring", "Target", "rest_w", "alpha_if", "alpha_pw", "alpha_wp", "Word"] + list(range(1,34))
-        inputHeader = ["Cycle", "Fullstring", "Target", "alpha_if", "alpha_pw", 'alpha_fp', "alpha_wp", "gamma_f",
-                       "gamma_p", "gamma_w", "param_combo", "Word"] + list(range(1, 34))
-
-        # here we go!
-        for achunk in pd.read_csv(self.File, compression='gzip', names=inputHeader,
-                                  chunksize=simsize, skipinitialspace=True, header=None):
-            # make sure simzise is applicable to your simulation
-
-            # print("chunk\n",achunk)
-            # for progresss reports
-            chunk_start_time = time.time()
-
-            # reinitialize resultsDF -- we're going to just print 1 line to csv for each chunk
-            resultsDF = pd.DataFrame(columns=resultsHeader)
-            # print('resultsDF/n', resultsDF.head())
-
-            # initialize inputDF and put the current chunk in there
-            inputDF = pd.DataFrame(columns=inputHeader)
-            inputDF = inputDF.append(achunk)
-
-            # define the target string
-            thetarget = inputDF['Target'].iloc[0]
-            
-            #print(inputDF)
-            #sys.exit()
-
-            # skip silence word
-            if thetarget == '-' or thetarget == 'Q':
-                continue
 
-            # process this chunk
-            simresult = self.processChunk(inputDF)
-            # print('simresult\n', simresult)
-
-            # set values for output file
-            # rest_w = inputDF['rest_w'].iloc[0]
-            alpha_if = inputDF['alpha_if'].iloc[0]
-            alpha_pw = inputDF['alpha_pw'].iloc[0]
-            alpha_fp = inputDF['alpha_fp'].iloc[0]
-            alpha_wp = inputDF['alpha_wp'].iloc[0]
-            gamma_f = inputDF['gamma_f'].iloc[0]
-            gamma_p = inputDF['gamma_p'].iloc[0]
-            gamma_w = inputDF['gamma_w'].iloc[0]
-            param_combo = inputDF['param_combo'].iloc[0]
-            # # set vals for the things in your header
-
-            # put the results in resultsDF -- always position 0 because we
-            # always reinitialize it. Probably a less scruffy way to do this...
-            simresultlist = [alpha_if, alpha_pw, alpha_fp, alpha_wp, gamma_f, gamma_p, gamma_w, param_combo,
-                             thetarget] + simresult
-            # print('simresutllist', simresultlist)
-            # print('resultsdf', resultsDF.head())
-            resultsDF.loc[0] = simresultlist
-
-            # if we are at the first chunk, we'll use write mode to overwrite existing file
-            # (no checking!) and include the header; else, we append
-            if atchunk == 0:
-                resultsDF.to_csv(self.outfile, mode='w', header=True, na_rep=np.NaN, index=False)
-            else:
-                resultsDF.to_csv(self.outfile, mode='a', header=False, na_rep=np.NaN, index=False)
+        # results are buffered and written in batches (everything not listed is float64):
+        # one file per alignment, or one long-format file with an alignment column
+        resultsTypes = {'alignment': object, 'param_combo': np.int64, 'Target': object, 'Recognized': np.int64,
+                        'rank': np.int64, 'word': object, 'peak_cycle': np.int64}
+        if self.alignmentOutput == 'long':
+            self.results = [ResultsSink(self.outfile, ['alignment'] + resultsHeader, resultsTypes,
+                                        self.format, self.batchSize, self.flushInterval)]
+        else:
+            self.results = [ResultsSink(self.alignmentFile(label), resultsHeader, resultsTypes,
+                                        self.format, self.batchSize, self.flushInterval)
+                            for label, alignment, copy in self.alignments]
+
+        # with --summary, the reductions every statistic comes from go to a summary
+        # directory that can be analyzed again without the word data (sim_summary.py)
+        self.summaries = SummaryWriter(self.summary, self.summarySettings()) if self.summary else None
+
+        # with --top, the strongest competitors of every simulation go to a long
+        # table (one row per alignment and rank)
+        self.topResults = ResultsSink(self.topFile(), resultsHeader[:9] + TOP_HEADER, resultsTypes,
+                                      self.format, self.batchSize, self.flushInterval) if self.top else None
+
+        # with --db, results, competitors and length effects also go to a SQLite
+        # database (results_db.py)
+        self.db = ResultsDB(self.dbFile, self.batchSize, self.flushInterval) if self.dbFile else None
+        self.lengthEffects.db = self.db
+
+        # with --sweep, accuracy and RT for every threshold go to a second table
+        if self.sweep:
+            sweepTable = SweepTable(self.sweepfile, self.thresholds, self.lucekValues if self.respProb else None)
+
+        # with --resume we pick up after the last checkpoint of an earlier run
+        completed = set()
+        if self.resume and all(sink.exists() for sink in self.results):
+            completed = self.loadCheckpoint()
+            atchunk = len(completed)
+            print('resuming after ' + str(atchunk) + ' simulations')
+        else:
+            for sink in self.results:
+                sink.reset()
+            if self.summaries:
+                self.summaries.reset()
+            if self.topResults:
+                self.topResults.reset()
+            self.lengthEffects.reset()
+            if os.path.exists(self.checkpoint):
+                os.remove(self.checkpoint)
+
+        # here we go! the input is either a word-data file, which we read block by
+        # block, or a store or summary directory (sim_store.py, --summary), which
+        # we index into. a --combos / --targets selection of an indexed file is
+        # read with seeks (sim_index.py). with --workers the simulations are
+        # analyzed in a process pool, but results still come back (and are
+        # written) in file order
+        if os.path.exists(os.path.join(self.File, 'summary.json')):
+            self.summaryIn = SimSummary(self.File)
+            self.checkSummary(self.summaryIn)
+            sims, analyze = self.readStore(completed), 'analyzeSummary'
+        elif os.path.isdir(self.File):
+            self.store = SimStore(self.File)
+            sims, analyze = self.readStore(completed), 'analyzeStored'
+        elif (self.combos is not None or self.targets is not None) and SimIndex.fresh(self.File):
+            self.store = SimIndex(self.File)
+            sims, analyze = self.readStore(completed), 'analyzeStored'
+        else:
+            sims, analyze = self.readBlocks(completed), 'analyzeBlock'
+        if self.workers > 1:
+            results = self.analyzeParallel(sims, analyze)
+        else:
+            results = ((meta, self.analyzeItem(analyze, item, n)) for n, (meta, item) in enumerate(sims, 1))
+
+        # per-simulation stage times, memory and throughput go to a JSONL file
+        metrics = MetricsLog(self.metricsfile, append=bool(completed))
+        readTime = self.readTime
+        for meta, (simresults, targetData, sweep, watch, summary, top) in results:
+            thetarget = meta['Target']
+            watch.times['read'] = watch.times.get('read', 0.0) + self.readTime - readTime
+            readTime = self.readTime
+
+            with watch.stage('write'):
+                # length-effects
+                self.lengthEffects.add(meta, thetarget, targetData)
+
+                # threshold / Luce k sweep
+                if self.sweep:
+                    sweepTable.add(meta, *sweep)
+
+                if self.summaries:
+                    self.summaries.add(meta, *summary)
+
+                if self.topResults:
+                    for (label, alignment, copy), (topWords, peaks, peakCycles) in zip(self.alignments, top):
+                        for rank, (word, peak, peakCycle) in enumerate(zip(topWords, peaks, peakCycles), 1):
+                            self.topResults.add([meta[h] for h in resultsHeader[:8]] +
+                                                [thetarget, label, rank, word, peak, peakCycle])
+                        if self.db:
+                            self.db.addCompetitors(label, meta, topWords, peaks, peakCycles)
+
+                # set values for output file(s); the sinks write them with the next batch
+                for i, simresult in enumerate(simresults):
+                    simresultlist = [meta[h] for h in resultsHeader[:8]] + [thetarget] + simresult
+                    if self.alignmentOutput == 'long':
+                        self.results[0].add([self.alignments[i][0]] + simresultlist)
+                    else:
+                        self.results[i].add(simresultlist)
+                    if self.db:
+                        self.db.addResult(self.alignments[i][0], meta, self.lengthEffects.length(thetarget),
+                                          simresult)
+
+                atchunk = atchunk + 1
+                if atchunk % self.checkpointEvery == 0:
+                    self.saveCheckpoint()
 
             # progress report
-            atchunk = atchunk + 1
-            chunk_time = str(round((time.time() - chunk_start_time), 2))
-            time_per_word = (time.time() - start_time) / atchunk
-            minutes_to_go = str(round(((time_per_word * (self.words * self.combinations - atchunk) / 60)), 2))
-            time_per_word = str(round(time_per_word, 2))
-
-            # print('self.words')
-            # print(self.words)
+            record = metrics.add(meta, watch.times, self.progress, watch.rows)
+            chunk_time = str(round(record['seconds'], 2))
+            time_per_word = str(round(1 / record['sims_per_s'], 2)) if record['sims_per_s'] else '?'
+            minutes_to_go = str(round(record['eta_s'] / 60, 2)) if record['eta_s'] is not None else '?'
 
             print(str(simresultlist) + ': ' + str(atchunk) + ' ' + thetarget + ': ' + chunk_time + ' secs, ' +
-                  time_per_word + ' secs/word, ' + str(self.words * self.combinations - atchunk) + ' words to go, ' +
-                  str(minutes_to_go) + ' minutes to go')
+                  time_per_word + ' secs/word, ' + str(round(100 * self.progress, 1)) + '% read, ' +
+                  minutes_to_go + ' minutes to go')
+
+        # That's it! We are done! The last combination's length effects go out
+        # before the final checkpoint, so a resumed finished run writes nothing twice
+        self.lengthEffects.close()
+        for sink in self.results:
+            sink.close()
+        if self.summaries:
+            self.summaries.close()
+        if self.topResults:
+            self.topResults.close()
+        if self.db:
+            self.db.close()
+        if atchunk > 0:
+            self.saveCheckpoint()
+        if self.sweep:
+            sweepTable.close()
+        metrics.close()
+        print('DONE.')
 
-        # That's it! We are done!
+    # Whether a simulation should be skipped: the silence word, simulations that are
+    # already in the results file and anything outside --combos / --targets
+    def skip(self, meta, completed):
+        if meta['Target'] == '-' or meta['Target'] == 'Q':
+            return True
+        if (str(meta['param_combo']), meta['Target']) in completed:
+            return True
+        if self.combos is not None and meta['param_combo'] not in self.combos:
+            return True
+        return self.targets is not None and meta['Target'] not in self.targets
+
+    # Splits the input file into one block of rows per simulation (see iterChunks)
+    # Input: set of completed (param_combo, Target) keys
+    # Output: generator of (metadata, block)
+    def readBlocks(self, completed=()):
+        stream = isStream(self.File)
+        indexing = self.writeIndex and not stream
+        with (openForIndexing(self.File) if indexing else openSimFile(self.File)) as f:
+            # progress is measured on the file itself (compressed bytes for gzip);
+            # a stream (stdin or a named pipe) has no size, so there is no ETA
+            raw = getattr(f, 'fileobj', f)
+            size = None if stream else max(os.fstat(raw.fileno()).st_size, 1)
+            # with --index a file is indexed on the way (sim_index.py), so single
+            # simulations can later be read with a seek
+            index = IndexWriter(self.File) if indexing else None
+            for offset, block in self.timeReads(prefetch(iterChunks(f, stream=stream))):
+                if size is not None:
+                    self.progress = min(raw.tell() / size, 1.0)
+                meta = parseMeta(block[:block.index(b'\n')])
+                if index:
+                    index.add(offset, len(block), meta)
+                if not self.skip(meta, completed):
+                    yield meta, block
+            if index:
+                index.close(f)
+
+    # Passes the blocks through, adding the time spent waiting for each one
+    # (decompressing and splitting) to self.readTime
+    def timeReads(self, blocks):
+        blocks = iter(blocks)
+        while True:
+            start = time.perf_counter()
+            block = next(blocks, None)
+            self.readTime += time.perf_counter() - start
+            if block is None:
+                return
+            yield block
+
+    # Picks the simulations to analyze from a store or a summary; nothing is read
+    # until a simulation is analyzed
+    # Input: set of completed (param_combo, Target) keys
+    # Output: generator of (metadata, position in the store)
+    def readStore(self, completed=()):
+        store = self.summaryIn or self.store
+        selected = store.select(self.combos, self.targets)
+        for n, i in enumerate(selected, 1):
+            self.progress = n / len(selected)
+            meta = store.meta(i)
+            if not self.skip(meta, completed):
+                yield meta, i
+
+    # Saves the length-effects state next to the results file: the combination
+    # still being aggregated plus the sizes of the results and length-effects
+    # output (both flushed and fsynced). The state file is replaced atomically,
+    # so a crash at any point leaves a consistent checkpoint
+    def saveCheckpoint(self):
+        if self.db:
+            self.db.flush()
+        state = {'lengthEffects': self.lengthEffects.state(), 'results': [sink.state() for sink in self.results],
+                 'summaries': self.summaries.state() if self.summaries else None,
+                 'top': self.topResults.state() if self.topResults else None}
+        with open(self.checkpoint + '.tmp', 'wb') as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.checkpoint + '.tmp', self.checkpoint)
+
+    # Restores the length-effects state of an interrupted run and cuts the results
+    # and length-effects files back to the last checkpoint, so all of them continue
+    # from the same simulation
+    # Output: set of completed (param_combo, Target) keys
+    def loadCheckpoint(self):
+        if os.path.exists(self.checkpoint):
+            with open(self.checkpoint, 'rb') as f:
+                state = pickle.load(f)
+            self.lengthEffects.restore(state['lengthEffects'])
+            for sink, sinkState in zip(self.results, state['results']):
+                sink.restore(sinkState)
+            if self.summaries:
+                self.summaries.restore(state.get('summaries'))
+            if self.topResults:
+                self.topResults.restore(state.get('top'))
+        else:
+            # no checkpoint: keep every complete row, but earlier length effects are lost
+            print('WARNING: no checkpoint ' + self.checkpoint + ', length effects restart from here')
+            for sink in self.results:
+                sink.restore(None)
+            if self.summaries:
+                self.summaries.restore(None)
+            if self.topResults:
+                self.topResults.restore(None)
+        return set.intersection(*[sink.completed() for sink in self.results])
+
+    # A summary input only has the alignments, Luce k values and eval words it
+    # was written with
+    # input: SimSummary
+    def checkSummary(self, summary):
+        header = summary.header
+        missing = [label for label, alignment, copy in self.alignments if label not in summary.labels]
+        if missing:
+            raise ValueError('summary ' + summary.path + ' has no ' + ', '.join(missing) + ' alignment')
+        if header['topSlices'] != self.topSlices:
+            raise ValueError('summary ' + summary.path + ' was written with topSlices ' + str(header['topSlices']))
+        if self.respProb and not set(self.kGrid()) <= set(header['lucekValues']):
+            raise ValueError('summary ' + summary.path + ' only has Luce k ' +
+                             ', '.join(str(k) for k in header['lucekValues']))
+
+    # Everything the outputs depend on besides the input (the --cache key)
+    def cacheSettings(self, cache):
+        return {'alignments': [list(a) for a in self.alignments], 'alignmentOutput': self.alignmentOutput,
+                'format': self.format, 'thresh': self.thresh, 'lucek': self.lucek, 'respProb': self.respProb,
+                'topSlices': self.topSlices, 'combos': self.combos, 'targets': self.targets, 'top': self.top,
+                'sweep': self.sweep, 'thresholds': self.thresholds.tolist() if self.sweep else None,
+                'lucekValues': list(self.lucekValues) if self.sweep and self.respProb else None,
+                'relations': cache.inputHash(self.relationsFile),
+                'lexicon': cache.fileHash(self.lexiconFile) if os.path.exists(self.lexiconFile) else None}
+
+    # What a summary depends on besides its own settings (summarySettings)
+    def summaryCacheSettings(self, cache):
+        return {'relations': cache.inputHash(self.relationsFile), 'combos': self.combos, 'targets': self.targets}
+
+    # A registered summary of the inputs this run can be analyzed from: same
+    # relations, every selected simulation and the settings checkSummary asks for
+    # output: summary directory or None
+    def cachedSummary(self, cache, files):
+        wanted = self.summaryCacheSettings(cache)
+        for path, settings in cache.summaries(files):
+            if settings['relations'] != wanted['relations']:
+                continue
+            if any(settings[h] is not None and settings[h] != wanted[h] for h in ('combos', 'targets')):
+                continue
+            try:
+                self.checkSummary(SimSummary(path))
+            except ValueError:
+                continue
+            return path
+        return None
+
+    # Loads the output files into the --db database (runs that were not written
+    # there as they went: merged shards and restored runs)
+    def importOutputs(self):
+        db = ResultsDB(self.dbFile)
+        for role, path in self.outputs():
+            if (role.startswith('results') or role == 'top') and os.path.exists(path):
+                importResults(db, path, role[len('results '):] or self.alignments[0][0], self.lengthEffects.lengths)
+        importLengthEffects(db, self.lengthEffects.prefix)
+        db.close()
+        print('outputs loaded into ' + self.dbFile)
+
+    # Outputs of a run as (role, path), for --cache
+    def outputs(self):
+        if self.alignmentOutput == 'long':
+            outputs = [('results', self.outfile)]
+        else:
+            outputs = [('results ' + label, self.alignmentFile(label)) for label, alignment, copy in self.alignments]
+        if self.sweep:
+            outputs.append(('sweep', self.sweepfile))
+        if self.top:
+            outputs.append(('top', self.topFile()))
+        return outputs + [('length effects targets', self.lengthEffects.targetsfile),
+                          ('length effects bins', self.lengthEffects.binsfile)]
+
+    # Results file of one alignment: the outfile itself for a single alignment,
+    # else the label is added to its name (results.csv -> results_ad-hoc.csv)
+    def alignmentFile(self, label):
+        if len(self.alignments) == 1:
+            return self.outfile
+        stem, ext = os.path.splitext(str(self.outfile))
+        return stem + '_' + label + ext
+
+    # File of the --top competitors: results.csv -> results_top10.csv
+    def topFile(self):
+        stem, ext = os.path.splitext(str(self.outfile))
+        return stem + '_top' + str(self.top) + ext
+
+    # Analyzes blocks in a pool of self.workers processes. At most 2 blocks per
+    # worker are in flight, so reading never runs far ahead of the analysis.
+    # Workers are spawned rather than forked since the reader thread is running
+    # Input: generator of (metadata, block or store position), analyze method name
+    # Output: generator of (metadata, analyzeSimulation result), in input order
+    def analyzeParallel(self, sims, analyze):
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=initWorker, initargs=(self,))
+        pending = deque()
+        try:
+            for n, (meta, item) in enumerate(sims, 1):
+                pending.append((meta, pool.submit(analyzeInWorker, analyze, item, n)))
+                if len(pending) >= 2 * self.workers:
+                    meta, future = pending.popleft()
+                    yield meta, future.result()
+            while pending:
+                meta, future = pending.popleft()
+                yield meta, future.result()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+
+    # Analyzes every shard in its own process (self.workers at a time) into
+    # <outfile>_shards/, then merges the results, sweep and length effects,
+    # keeping each (param_combo, Target) once and ordering by param_combo and Target.
+    # With --resume every shard resumes from its own checkpoint
+    # Input: list of word-data files
+    def processShards(self, files):
+        shardDir = os.path.splitext(str(self.outfile))[0] + '_shards'
+        os.makedirs(shardDir, exist_ok=True)
+        jobs = [self.shard(path, shardDir) for path in files]
+
+        pool = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+        try:
+            for future in [pool.submit(processShard, job) for job in jobs]:
+                future.result()
+        finally:
+            pool.shutdown(cancel_futures=True)
+
+        if self.alignmentOutput == 'long':
+            outputs = [(self.outfile, [job.outfile for job in jobs])]
+        else:
+            labels = [alignment[0] for alignment in self.alignments]
+            outputs = [(self.alignmentFile(label), [job.alignmentFile(label) for job in jobs]) for label in labels]
+        for outfile, paths in outputs:
+            rows = shards.mergeResults(paths, outfile, self.format)
+            print(str(rows) + ' results from ' + str(len(jobs)) + ' shards in ' + outfile)
+        if self.top:
+            shards.mergeResults([job.topFile() for job in jobs], self.topFile(), self.format)
+        if self.sweep:
+            shards.mergeSweeps([job.sweepfile for job in jobs], self.sweepfile)
+        length_effects.mergeFiles([job.lengthEffects.prefix for job in jobs], self.lengthEffects.prefix)
+        if self.summary:
+            n = mergeSummaries([job.summary for job in jobs], self.summary)
+            print(str(n) + ' summaries from ' + str(len(jobs)) + ' shards in ' + self.summary)
         print('DONE.')
 
+    # The Analysis of one shard: same settings, outputs in shardDir, one worker
+    def shard(self, path, shardDir):
+        job = copy.copy(self)
+        job.File = path
+        job.name = os.path.join(shardDir, os.path.basename(path))
+        job.outfile = job.name + '_results.' + self.format
+        job.sweepfile = job.name + '_sweep.csv'
+        job.metricsfile = job.name + '_metrics.jsonl'
+        job.summary = job.name + '_summary' if self.summary else None
+        job.cache = None
+        job.dbFile = None
+        job.lengthEffectsFiles(self.lengthEffects.lengths)
+        job.workers = 1
+        return job
+
+
+def processShard(job):
+    job.processFile()
+
+
+# Each worker process gets its own copy of the Analysis object
+workerAnalysis = None
+
+
+def initWorker(analysis):
+    global workerAnalysis
+    workerAnalysis = analysis
+
+
+def analyzeInWorker(analyze, item, n):
+    return workerAnalysis.analyzeItem(analyze, item, n)
+
 
 ###########################################################
 
@@ -443,27 +1125,82 @@ def parse():
     parser = argparse.ArgumentParser(prog='analysis',
                                      description='Calculates accuracy and reaction time from simulation files')
 
-    parser.add_argument('File', metavar='file', type=str, help='the csv file to process')
-    parser.add_argument('-a', '--alignment', action='store', choices=['specified', 'post-hoc', 'ad-hoc'],
-                        default='post-hoc',
-                        help='type of alignment')
-    parser.add_argument('-s', '--specified', action='store', type=int, metavar='COPY', default=4,
-                        help='word copy X when alignment is specified')
+    parser.add_argument('File', metavar='file', type=str,
+                        help="the csv file to process, '-' or a named pipe to analyze a simulation as it "
+                             'runs, a store directory made by sim_store.py, or a glob pattern / directory of '
+                             'csv files (shards, analyzed concurrently with --workers), or a summary directory '
+                             'written with --summary')
+    parser.add_argument('-a', '--alignment', action='store', choices=['specified', 'post-hoc', 'ad-hoc', 'all'],
+                        nargs='+', default=['post-hoc'],
+                        help='type(s) of alignment, all computed from one read of the file')
+    parser.add_argument('-s', '--specified', action='store', type=int, metavar='COPY', nargs='+', default=[4],
+                        help='word copy X (or copies) when alignment is specified')
+    parser.add_argument('-ao', '--alignmentOutput', action='store', choices=['files', 'long'], default='files',
+                        help='with several alignments, one results file each or one file with an alignment column'
+                             ' (sweep and length effects use the first alignment)')
     parser.add_argument('-k', '--lucek', action='store', type=int, metavar='K', default=13,
                         help='Luce Choice Rule k value')
     parser.add_argument('-ls', '--lastSlice', action='store', metavar='SLICE', type=int, default=12,
                         help='first N-2 slices to find the most activated slice')
     parser.add_argument('-of', '--outfile', type=str, metavar='FILENAME', default='outfile',
                         help='name for output file')
+    parser.add_argument('-fmt', '--format', action='store', choices=['csv', 'parquet'], default='csv',
+                        help='results format (parquet: a directory of part files, needs pyarrow)')
+    parser.add_argument('-bs', '--batchSize', action='store', type=int, metavar='N', default=500,
+                        help='write results in batches of N rows')
+    parser.add_argument('-fi', '--flushInterval', action='store', type=float, metavar='SECONDS', default=60,
+                        help='also write the results batch after this many seconds')
     parser.add_argument('-rp', '--respProb', action='store_true',
                         help='use response probabilities (rather than word activations)')
-    parser.add_argument('-th', '--thresh', action='store', type=float, default=0.4, help='accuracy threshold value')
-    parser.add_argument('-ts', '--topSlices', action='store', type=int, metavar='SLICE', default=50,
-                        help='top N activated slices')
+    parser.add_argument('-th', '--thresh', action='store', type=float, default=0.41, help='accuracy threshold value')
+    parser.add_argument('-sw', '--sweep', action='store_true',
+                        help='also write accuracy and RT for a grid of thresholds (and Luce k values with --respProb)')
+    parser.add_argument('-ths', '--thresholds', action='store', type=float, nargs=3, metavar=('START', 'STOP', 'STEP'),
+                        default=[0.1, 0.995, 0.01], help='threshold grid for --sweep')
+    parser.add_argument('-ks', '--lucekValues', action='store', type=int, nargs='+', metavar='K',
+                        help='Luce k values for --sweep --respProb (default: --lucek)')
+    parser.add_argument('-ts', '--topSlices', action='store', type=int, metavar='SLICE', default=14678,
+                        help='top N activated slices (including silence; the default keeps every word of lemmalex)')
     parser.add_argument('-w', '--words', action='store', type=int, metavar='SIMSIZE', default=901,
-                        help='Number of words in lexicon (used to parse file)')
+                        help='Number of words in lexicon (sizes the length-effects buffer of a param_combo, which '
+                             'grows if needed; simulations are split on their Target and param_combo)')
     parser.add_argument('-c', '--cycles', action='store', type=int, metavar='SIMSIZE', default=100,
-                        help='Number of cycles per simulation (used to parse file)')
+                        help='Number of cycles per simulation (ignored: the cycles are read from the data)')
+    parser.add_argument('-j', '--workers', action='store', type=int, metavar='N', default=1,
+                        help='analyze simulations in N worker processes')
+    parser.add_argument('-cb', '--combos', action='store', type=int, nargs='+', metavar='COMBO',
+                        help='only analyze these param_combo values')
+    parser.add_argument('-tg', '--targets', action='store', type=str, nargs='+', metavar='TARGET',
+                        help='only analyze these targets')
+    parser.add_argument('-rel', '--relations', type=str, metavar='FILENAME', default='./flex2_rhymes_cohorts.pickle',
+                        help='rhymes/cohorts relation table (.rel directory) or pickle made by rhymes-cohorts.py')
+    parser.add_argument('-r', '--resume', action='store_true',
+                        help='continue an interrupted run, skipping simulations already in the output file')
+    parser.add_argument('-ce', '--checkpointEvery', action='store', type=int, metavar='N', default=100,
+                        help='checkpoint length effects every N simulations (used by --resume)')
+    parser.add_argument('-pe', '--profileEvery', action='store', type=int, metavar='N',
+                        help='run every Nth simulation under cProfile (stats next to the metrics file)')
+    parser.add_argument('-sum', '--summary', type=str, metavar='DIR',
+                        help='also write per-simulation summaries to DIR; give DIR as the input later to '
+                             'analyze again without the word data (same alignments, topSlices and Luce k values)')
+    parser.add_argument('-tc', '--competitors', action='store', type=int, metavar='N', default=10,
+                        help='competitor trajectories kept per simulation in --summary')
+    parser.add_argument('-top', '--top', action='store', type=int, metavar='K',
+                        help='also write the K strongest competitors of every simulation (word, peak value and '
+                             'peak cycle) to <outfile>_topK')
+    parser.add_argument('-cache', '--cache', type=str, metavar='DIR',
+                        help='reuse the outputs of identical earlier runs (same input content and settings) kept '
+                             'in DIR, and their --summary directories when only the threshold or Luce k changed')
+    parser.add_argument('-db', '--db', type=str, metavar='FILENAME',
+                        help='also write results, --top competitors and length effects to this SQLite database '
+                             '(query it with results_db.py)')
+    parser.add_argument('-ix', '--index', action='store_true',
+                        help='also index a word-data file while reading it (<file>.index/, see sim_index.py), so '
+                             'later --combos / --targets runs read single simulations with a seek')
+    parser.add_argument('-lex', '--lexicon', type=str, metavar='FILENAME',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'data',
+                                             'lemmalex-with-trace-pronunciations-unique.csv'),
+                        help='lexicon with a Length column, for the length-effects bins')
 
     return parser
 
@@ -471,9 +1208,10 @@ def parse():
 if __name__ == "__main__":
     parser = parse()
     args = parser.parse_args()
+    if args.sweep and args.resume:
+        parser.error('--sweep cannot be combined with --resume')
     a = Analysis(vars(args))
 
-    rhymes_cohorts_dir = './'
     # beg_time = time.time()
 
     attributes = vars(a)
@@ -484,14 +1222,13 @@ if __name__ == "__main__":
     # this allows users to run this command with multiple files (separate runs) without
     # having to define the outfile
     if a.outfile == 'outfile':
-        a.outfile = str(a.File) + '_results_0.42.csv'
+        a.outfile = a.name + '_results_0.42.' + a.format
+        a.sweepfile = a.name + '_sweep.csv'
+        a.metricsfile = a.name + '_metrics.jsonl'
+        a.lengthEffectsFiles(a.lengthEffects.lengths)
 
     a.processFile()
 
-    with open(str(a.File)+'length_effects_DF_list.pkl', 'wb') as f:
-        pickle.dump(length_effects_DF_list,f)
-
-
     l1, l2, l3 = psutil.getloadavg()
     CPU_use = (l3 / os.cpu_count()) * 100
 
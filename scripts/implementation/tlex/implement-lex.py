@@ -1,9 +1,12 @@
 # Nikita Sossounov 2022
 # This script does not account for true word frequency
 
+import os
+
 import pandas as pd
 
-indir = '/Users/nikitasossounov/thesis/jsTRACE/JSTrace-repo/scripts/pseudo-lexicon/'
+# indir = '/Users/nikitasossounov/thesis/jsTRACE/JSTrace-repo/scripts/pseudo-lexicon/'
+indir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'pseudo-lexicon', '')
 outdir = './'
 
 df = pd.read_csv(indir+'pseudo-lexicon.csv')
@@ -1,71 +1,123 @@
 # Nikita Sossounov 2022
 
-import sys
+import argparse
+import os
+
+import numpy as np
 import pandas as pd
 
 pd.set_option('display.max_columns', None)
 pd.set_option('display.width', 1000)
 
-
-indir = '/Users/nikitasossounov/thesis/jsTRACE/JSTrace-repo/data/'
-outdir = './'
-
-# read lemmalex into df
-df = pd.read_csv(indir+'lemmalex-with-trace-pronunciations-unique.csv')
-# print(df)
-
-# keep resampling until word length condition is satisfied
-while True:
-    # choose sample size
-    sample = df.sample(n=200)
-    # print(sample)
-
-    s = sample.Phonology.str.len().sort_values().index
-    sampleSort = sample.reindex(s)
-    low = sampleSort.iloc[0:20]
-    high = sampleSort.iloc[180:200]
-
-    if (low.Length <= 3).all() and (high.Length >= 6).all():
-        break
-
-print(low)
-print(high)
-print(sample)
-
-
-# extract phoneme codes to ensure all phonemes occur in sample at least once
-features = pd.read_csv(indir+'jstrace-phonetic-features-2022-v3.csv')
-code = features['CODE'].tolist()
-code.remove('SKIP/x')
-code.remove('-')
-code.remove('H')
-
-# check which phonemes haven't occured in the sample yet
-not_in_sample = code
-for i in sample['Phonology']:
-    for j in code:
-        if j in i:
-            not_in_sample.remove(j)
-
-# keep adding words to the sample until all phonemes are used
-while True:
-    agent = df.sample(n=1)
-    agent_word = agent['Phonology'].to_string(index=False)
-    if not not_in_sample:
-        break
-    for i in not_in_sample:
-        if str(i) in agent_word:
-            sample = pd.concat([sample, agent])
-            not_in_sample.remove(i)
-
-
-print(not_in_sample)
-print(sample)
-
-sample = sample.drop_duplicates(keep=False)
-
-sys.exit()
-sample.to_csv(outdir+'pseudo-lexicon.csv', index=False)
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+# Samples a pseudo-lexicon from lemmalex such that
+#   - the `short` shortest words are at most 3 phonemes and the `short` longest
+#     at least 6 (at least that many words of each kind), and
+#   - every phoneme of the feature table occurs in some word,
+# in one bounded pass instead of resampling until both hold: the words of each
+# length stratum are drawn directly, the phonemes they miss are covered greedily
+# (the word with the most missing phonemes, ties in random order, until none are
+# missing) and the rest is a random draw from the remaining words. A words x
+# phonemes incidence matrix is built once, so covering costs one column sum per
+# added word. The same seed gives the same lexicon.
+
+
+# Phoneme codes of the feature table, without silence and the non-phoneme codes
+def phonemeCodes(featuresfile):
+    code = pd.read_csv(featuresfile)['CODE'].tolist()
+    return [c for c in code if c not in ('SKIP/x', '-', 'H')]
+
+
+# input: phonology strings (one character per phoneme), phoneme codes
+# output: (words, phonemes) boolean array, True where the word contains the phoneme
+def incidence(phonology, codes):
+    column = {c: j for j, c in enumerate(codes)}
+    matrix = np.zeros((len(phonology), len(codes)), dtype=bool)
+    for i, phon in enumerate(phonology):
+        matrix[i, [column[p] for p in set(phon) if p in column]] = True
+    return matrix
+
+
+# input: lexicon DataFrame (Phonology), phoneme codes, size of the pseudo-lexicon,
+#        number of short and of long words, what counts as short and as long (in
+#        phonemes), random seed
+# output: DataFrame of `size` lexicon rows in random order
+def samplePseudoLexicon(df, codes, size=200, short=20, maxShort=3, minLong=6, seed=None):
+    if size > len(df):
+        raise ValueError('the lexicon has %d words, fewer than %d' % (len(df), size))
+    rng = np.random.default_rng(seed)
+    lengths = df['Phonology'].str.len().to_numpy()
+    matrix = incidence(df['Phonology'].tolist(), codes)
+
+    shortWords = np.flatnonzero(lengths <= maxShort)
+    longWords = np.flatnonzero(lengths >= minLong)
+    if len(shortWords) < short or len(longWords) < short:
+        raise ValueError('the lexicon has %d words of at most %d phonemes and %d of at least %d, '
+                         '%d of each are needed' % (len(shortWords), maxShort, len(longWords), minLong, short))
+    missing = ~matrix.any(axis=0)
+    if missing.any():
+        raise ValueError('no word contains ' + ', '.join(np.array(codes)[missing]))
+
+    # length strata
+    chosen = np.zeros(len(df), dtype=bool)
+    chosen[rng.choice(shortWords, short, replace=False)] = True
+    chosen[rng.choice(longWords, short, replace=False)] = True
+
+    # greedy cover of the phonemes the strata miss (at most one word per phoneme)
+    order = rng.permutation(len(df))
+    uncovered = ~matrix[chosen].any(axis=0)
+    while uncovered.any():
+        gain = matrix[order][:, uncovered].sum(axis=1)
+        gain[chosen[order]] = 0
+        best = order[np.argmax(gain)]
+        chosen[best] = True
+        uncovered &= ~matrix[best]
+
+    if chosen.sum() > size:
+        raise ValueError('%d words are needed for the length and phoneme constraints, more than %d'
+                         % (chosen.sum(), size))
+    rest = np.flatnonzero(~chosen)
+    chosen[rng.choice(rest, size - chosen.sum(), replace=False)] = True
+    return df.iloc[rng.permutation(np.flatnonzero(chosen))]
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='get-pseudo-lex',
+                                     description='Samples a pseudo-lexicon with short and long words and every phoneme')
+    parser.add_argument('File', metavar='file', type=str, nargs='?',
+                        default=os.path.join(HERE, '..', '..', 'data', 'lemmalex-with-trace-pronunciations-unique.csv'),
+                        help='lexicon csv with a Phonology column (default: lemmalex)')
+    parser.add_argument('-ft', '--features', type=str, metavar='FILENAME',
+                        default=os.path.join(HERE, '..', '..', 'data', 'jstrace-phonetic-features-2022-v3.csv'),
+                        help='phonetic feature table whose CODE column lists the phonemes')
+    parser.add_argument('-n', '--size', type=int, default=200, help='number of words')
+    parser.add_argument('-sh', '--short', type=int, default=20, metavar='N',
+                        help='the N shortest words are at most --maxShort phonemes and the N longest at least '
+                             '--minLong')
+    parser.add_argument('--maxShort', type=int, default=3, metavar='PHONEMES')
+    parser.add_argument('--minLong', type=int, default=6, metavar='PHONEMES')
+    parser.add_argument('-s', '--seed', type=int, help='random seed')
+    parser.add_argument('-o', '--outfile', type=str, default='./pseudo-lexicon.csv', help='csv to write')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+
+    # read lemmalex into df
+    df = pd.read_csv(args.File, keep_default_na=False)
+
+    sample = samplePseudoLexicon(df, phonemeCodes(args.features), args.size, args.short, args.maxShort,
+                                 args.minLong, args.seed)
+
+    sampleSort = sample.iloc[np.argsort(sample['Phonology'].str.len().to_numpy(), kind='stable')]
+    print(sampleSort.iloc[0:args.short])
+    print(sampleSort.iloc[len(sample) - args.short:])
+    print(sample)
+
+    sample.to_csv(args.outfile, index=False)
 # add a couple of inflections manually
 # 1000001,toys,T OY S,tOs,16.84,2
 # 1000002,canes,K EY N S,kens,8.33,3
@@ -0,0 +1,103 @@
+# Phonological neighborhoods of a lexicon
+#
+# Builds, over the TRACE phonology strings of a lexicon (one character per
+# phoneme), the relations
+#   deletion       words made by deleting one phoneme of the word
+#   addition       words made by adding one phoneme (deletion transposed)
+#   substitution   words made by replacing one phoneme
+#   das            any of the three (the usual neighborhood)
+#   embedded       words contained in the word (contiguous, not the word itself)
+#   carriers       words that contain the word (embedded transposed)
+# without comparing words pairwise: every word is hashed under its deletion
+# variants (the word with one phoneme deleted, and for substitutions also the
+# position deleted), so neighbors are the words found under the same key. Time is
+# O(N * L) for the neighbors and O(N * L^2) for the embeddings; the 17k-word
+# lemmalex takes about a second.
+# Each relation is a CSR matrix over word ids (see relation_table).
+#
+# usage: python neighbors.py ../../data/lemmalex-with-trace-pronunciations-unique.csv -o lemmalex_neighbors.rel
+
+import argparse
+import os
+import time
+
+import pandas as pd
+
+import relation_table
+from relation_table import CSR
+
+
+# Vocabulary of a lexicon: each phonology string once, in lexicon order
+def vocabulary(lexicon):
+    return list(dict.fromkeys(lexicon))
+
+
+# input: list of distinct phonology strings
+# output: dict of relation name -> CSR
+def neighbors(words, minEmbedded=1):
+    ids = {word: i for i, word in enumerate(words)}
+    n = len(words)
+
+    # deletion: a deletion variant that is itself a word
+    rows, cols = [], []
+    for i, word in enumerate(words):
+        for pos in range(len(word)):
+            j = ids.get(word[:pos] + word[pos + 1:])
+            if j is not None:
+                rows.append(i)
+                cols.append(j)
+    deletion = CSR.fromPairs(rows, cols, n)
+
+    # substitution: two words with the same deletion variant at the same position
+    groups = {}
+    for i, word in enumerate(words):
+        for pos in range(len(word)):
+            groups.setdefault((pos, word[:pos] + word[pos + 1:]), []).append(i)
+    rows, cols = [], []
+    for group in groups.values():
+        if len(group) > 1:
+            for i in group:
+                rows += [i] * (len(group) - 1)
+                cols += [j for j in group if j != i]
+    substitution = CSR.fromPairs(rows, cols, n)
+
+    # embedded: every substring (of at least minEmbedded phonemes) that is a word
+    rows, cols = [], []
+    for i, word in enumerate(words):
+        for start in range(len(word)):
+            for end in range(start + minEmbedded, len(word) + 1):
+                j = ids.get(word[start:end])
+                if j is not None and j != i:
+                    rows.append(i)
+                    cols.append(j)
+    embedded = CSR.fromPairs(rows, cols, n)
+
+    addition = deletion.transpose()
+    return {'deletion': deletion, 'addition': addition, 'substitution': substitution,
+            'das': deletion.union(addition, substitution), 'embedded': embedded, 'carriers': embedded.transpose()}
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='neighbors',
+                                     description='Builds deletion/addition/substitution neighbors and embedded '
+                                                 'words of a lexicon as sparse matrices')
+    parser.add_argument('File', metavar='file', type=str, help='lexicon csv with a Phonology column')
+    parser.add_argument('-o', '--outfile', type=str, default='neighbors.rel', help='relation table to write')
+    parser.add_argument('-me', '--minEmbedded', type=int, default=1, metavar='PHONEMES',
+                        help='shortest embedded word to count')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+    lexDF = pd.read_csv(args.File, usecols=['Phonology'], dtype={'Phonology': str}, keep_default_na=False)
+    words = vocabulary(lexDF['Phonology'])
+
+    start = time.perf_counter()
+    relations = neighbors(words, args.minEmbedded)
+    print(str(len(words)) + ' words in ' + str(round(time.perf_counter() - start, 2)) + ' secs')
+    for name, matrix in relations.items():
+        degree = matrix.degree()
+        print('  %-13s %8d pairs, mean %.2f per word, %d words without any' %
+              (name, len(matrix), degree.mean(), (degree == 0).sum()))
+    relation_table.write(args.outfile, words, relations, os.path.basename(args.File))
@@ -0,0 +1,215 @@
+# Word relations as sparse matrices, and the relation-table format
+#
+# A relation (cohorts, rhymes, substitution neighbors, ...) is a words x words
+# 0/1 matrix in CSR form over integer word ids: the related words of word i are
+# indices[indptr[i]:indptr[i + 1]], sorted by id. Averaging a trajectory per
+# relation class is then one product of the matrix with a (words, cycles) array.
+#
+# A relation table is a directory (rhymes-cohorts.py and neighbors.py write one,
+# by convention named *.rel) of plain .npy arrays, so it is memory-mapped rather
+# than read, opens in milliseconds and is shared read-only by worker processes:
+#   header.json              format, version, number of words, sha256 of the
+#                            vocabulary (lexicon_sha256), source and the relations
+#   words.npy                vocabulary: id -> phonology string
+#   <relation>.indptr.npy    CSR offsets (words + 1, int64)
+#   <relation>.indices.npy   CSR word ids (int32)
+# Loading needs numpy only (no pandas). Pickled relation tables written by the
+# earlier rhymes-cohorts.py convert with
+#   python relation_table.py tlex_rhymes_cohorts.pickle tlex_rhymes_cohorts.rel
+
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+FORMAT = 'jstrace-relations'
+VERSION = 1
+
+
+class CSR:
+    def __init__(self, indptr, indices, shape):
+        self.indptr = indptr
+        self.indices = indices
+        self.shape = shape
+
+    # input: row ids, column ids (pairs may repeat), number of words
+    @classmethod
+    def fromPairs(cls, rows, cols, n):
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        pairs = np.unique(rows * n + cols)
+        rows, cols = np.divmod(pairs, n)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+        return cls(indptr, cols.astype(np.int32), (n, n))
+
+    # ids related to word i
+    def row(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def transpose(self):
+        rows = np.repeat(np.arange(self.shape[0]), self.degree())
+        return CSR.fromPairs(self.indices, rows, self.shape[0])
+
+    def union(self, *others):
+        rows = np.concatenate([np.repeat(np.arange(m.shape[0]), m.degree()) for m in (self,) + others])
+        cols = np.concatenate([m.indices for m in (self,) + others])
+        return CSR.fromPairs(rows, cols, self.shape[0])
+
+    # Product with a dense (words, ...) array: row i is the sum over the related words
+    # (one segment sum per non-empty row, so a row does not depend on the others)
+    def dot(self, dense):
+        dense = np.asarray(dense)
+        sums = np.zeros((self.shape[0],) + dense.shape[1:], dtype=np.result_type(dense, np.float64))
+        rows = np.flatnonzero(self.degree())
+        if len(rows):
+            sums[rows] = np.add.reduceat(dense[self.indices], self.indptr[rows], axis=0)
+        return sums
+
+    # Mean over the related words of every word (NaN for words without any)
+    def mean(self, dense):
+        degree = self.degree().reshape((-1,) + (1,) * (np.ndim(dense) - 1))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.dot(dense) / degree
+
+    # The matrix after a lexicon edit: rows of removed words dropped, rows of new
+    # words appended and the rows that change replaced. The other rows are copied
+    # as they are (with ids renumbered if words were removed), nothing is re-sorted
+    # input: new id of every word (-1: removed; kept words keep their order and new
+    #        words come after them), number of words after the edit, dict of new
+    #        id -> related new ids for every row that changes (new words, and every
+    #        row that mentions a removed word)
+    def edited(self, newIds, n, rows):
+        newIds = np.asarray(newIds, dtype=np.int64)
+        replaced = np.zeros(n, dtype=bool)
+        replaced[list(rows)] = True
+        keepRow = newIds >= 0
+        keepRow[keepRow] = ~replaced[newIds[keepRow]]
+        kept = self.indices[np.repeat(keepRow, self.degree())]
+        if (newIds < 0).any():
+            kept = newIds[kept]
+        degree = np.zeros(n, dtype=np.int64)
+        degree[newIds[keepRow]] = self.degree()[keepRow]
+        for i, row in rows.items():
+            degree[i] = len(row)
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(degree, out=indptr[1:])
+        indices = np.empty(indptr[-1], dtype=np.int32)
+        fill = np.ones(indptr[-1], dtype=bool)
+        for i, row in rows.items():
+            fill[indptr[i]:indptr[i + 1]] = False
+            indices[indptr[i]:indptr[i + 1]] = np.sort(row)
+        indices[fill] = kept
+        return CSR(indptr, indices, (n, n))
+
+    def toScipy(self):
+        from scipy.sparse import csr_matrix
+        return csr_matrix((np.ones(len(self), dtype=np.int8), self.indices, self.indptr), shape=self.shape)
+
+
+# sha256 of a vocabulary (the words in id order), to tell which lexicon a table is for
+def lexiconHash(words):
+    return hashlib.sha256('\n'.join(words).encode()).hexdigest()
+
+
+# Relations from lists of related words, as rhymes-cohorts.py makes them
+# input: lexicon, targets, dict of relation name -> one list of related words per target
+# output: vocabulary (the lexicon, then targets and related words it lacks) and
+#         dict of relation name -> CSR
+def fromLists(lexicon, targets, lists):
+    words = list(dict.fromkeys(list(lexicon) + list(targets) +
+                               [word for related in lists.values() for row in related for word in row]))
+    ids = {word: i for i, word in enumerate(words)}
+    relations = {}
+    for name, related in lists.items():
+        rows = [ids[target] for target, row in zip(targets, related) for word in row]
+        cols = [ids[word] for row in related for word in row]
+        relations[name] = CSR.fromPairs(rows, cols, len(words))
+    return words, relations
+
+
+def isTable(path):
+    return os.path.exists(os.path.join(str(path), 'header.json'))
+
+
+# Writes a relation table (replacing an existing one)
+# input: directory, vocabulary (id order), dict of relation name -> CSR, source description
+def write(path, words, relations, source=None):
+    tmp = str(path).rstrip('/' + os.sep) + '.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, 'words.npy'), np.array(words, dtype=str))
+    for name, matrix in relations.items():
+        np.save(os.path.join(tmp, name + '.indptr.npy'), np.asarray(matrix.indptr, dtype=np.int64))
+        np.save(os.path.join(tmp, name + '.indices.npy'), np.asarray(matrix.indices, dtype=np.int32))
+    header = {'format': FORMAT, 'version': VERSION, 'words': len(words), 'lexicon_sha256': lexiconHash(words),
+              'source': source, 'relations': {name: {'pairs': len(matrix)} for name, matrix in relations.items()}}
+    with open(os.path.join(tmp, 'header.json'), 'w') as f:
+        json.dump(header, f, indent=1)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+
+
+# A relation table opened read-only. Arrays are memory-mapped; pickling (e.g. to
+# worker processes) only sends the path and each process maps the files itself
+class RelationTable:
+    def __init__(self, path):
+        self.path = str(path)
+        with open(os.path.join(self.path, 'header.json')) as f:
+            self.header = json.load(f)
+        if self.header.get('format') != FORMAT or self.header.get('version', 0) > VERSION:
+            raise ValueError(self.path + ' is not a relation table this version can read')
+        self.open()
+
+    def open(self):
+        self.words = np.load(os.path.join(self.path, 'words.npy'), mmap_mode='r')
+        n = len(self.words)
+        self.relations = {name: CSR(np.load(os.path.join(self.path, name + '.indptr.npy'), mmap_mode='r'),
+                                    np.load(os.path.join(self.path, name + '.indices.npy'), mmap_mode='r'), (n, n))
+                          for name in self.header['relations']}
+        self.wordIds = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'header': self.header}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __getitem__(self, name):
+        return self.relations[name]
+
+    # word -> id (built on first use)
+    def ids(self):
+        if self.wordIds is None:
+            self.wordIds = {word: i for i, word in enumerate(self.words.tolist())}
+        return self.wordIds
+
+    # Words related to a word (empty for words not in the table)
+    def related(self, name, word):
+        i = self.ids().get(word)
+        return [] if i is None else [str(self.words[j]) for j in self.relations[name].row(i)]
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit('usage: python relation_table.py rhymes_cohorts.pickle rhymes_cohorts.rel')
+    import pickle
+    with open(sys.argv[1], 'rb') as f:
+        cohorts_rhymesDF = pickle.load(f)
+    targets = cohorts_rhymesDF['Phonology'].tolist()
+    words, relations = fromLists(targets, targets, {name: cohorts_rhymesDF[name].tolist()
+                                                    for name in ('cohorts', 'rhymes')})
+    write(sys.argv[2], words, relations, os.path.basename(sys.argv[1]))
+    print(str(len(words)) + ' words, ' + ', '.join(name + ' ' + str(len(m)) for name, m in relations.items()))
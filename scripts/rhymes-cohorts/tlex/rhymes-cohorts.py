@@ -1,179 +1,286 @@
 # Nikita Sossounov 2022
 
+import argparse
+import os
 import pickle
-import re
 import sys
-import pandas as pd
-
-pd.set_option('max_colwidth', 1000)
-pd.set_option('display.max_columns', None)
-pd.set_option('display.max_rows', None)
-pd.options.display.width = 0
-
-
-
-indir = '/Users/nikitasossounov/thesis/jsTRACE/JSTrace-repo/scripts/pseudo-lexicon/'
-outdir = './'
-
-df = pd.read_csv(indir + 'pseudo-lexicon.csv')
-
-df['rhymes'] = ''
-df['cohorts'] = ''
-
-print(df)
-
-lexicon = df.Phonology.tolist()
-print(lexicon)
-
-# cohorts
-for i in range(0,len(df)):
-    lst = []
-    if len(df['Phonology'][i]) > 1:
-        for word in lexicon:
-            start = df['Phonology'][i][0:2]
-            if word.startswith(start) and word != df['Phonology'][i]:
-                lst.append(word)
-    df.at[i,'cohorts'] = lst
-
-# rhymes
-for i in range(0,len(df)):
-    lst = []
-    if len(df['Phonology'][i]) > 1:
-        for word in lexicon:
-            end = df['Phonology'][i][1:len(df['Phonology'][i])]
-            if word.endswith(end) and word != df['Phonology'][i] and (len(word) == len(df['Phonology'][i]) or (len(word) == len(df['Phonology'][i]) - 1)):
-                lst.append(word)
-            if (len(word) == len(df['Phonology'][i]) + 1) and word[1:len(word)] == df['Phonology'][i]:
-                lst.append(word)
-    else:
-        end = df['Phonology'][i]
-        # print('end', end)
-        if word.endswith(end) and word != df['Phonology'][i] and (len(word) == len(df['Phonology'][i]) or (len(word) == len(df['Phonology'][i]) - 1)):
-            lst.append(word)
-        if (len(word) == len(df['Phonology'][i]) + 1) and word[1:len(word)] == df['Phonology'][i]:
-            lst.append(word)
-    df.at[i,'rhymes'] = lst
+import time
 
-print(df)
-print(df['rhymes'])
-
-with open(outdir+'tlex_rhymes_cohorts.pickle','wb') as f:
-    pickle.dump(df, f)
-
-sys.exit()
-
-
-cohorts = dict.fromkeys(lexicon, [])
-rhymes = dict.fromkeys(lexicon, [])
-rhymes2 = dict.fromkeys(lexicon, [])
-
-# print(type(cohorts['^']))
-# print('cohorts ' + cohorts +'\n')
-
-for key, value in cohorts.items():
-    # print(key,value)
+import numpy as np
+import pandas as pd
 
-    cohort_list = []
-    if len(key) > 1:
-        for word in lexicon:
-            # print('word', word)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import relation_table  # noqa: E402
+
+
+# Cohorts and rhymes by lookup instead of comparing every pair of words. Every
+# rule compares a word with the target after dropping a fixed number of leading
+# phonemes, so three dictionaries cover all of them:
+#   prefixes   first two phonemes -> words   (cohorts)
+#   tails      word without its first phoneme -> words
+#   tails2     word without its first two phonemes -> words
+# plus words -> positions. Each holds lexicon positions in lexicon order, so the
+# lists come out in the same order as with the nested loops. Building is one pass
+# over the lexicon and a lookup only touches the words it returns. Words can be
+# added (at the end of the lexicon) and removed, and the same dictionaries tell
+# which words' lists an edit changes (see affected and updateTable)
+class LexiconIndex:
+    def __init__(self, lexicon):
+        self.lexicon = list(lexicon)
+        self.positions = {}
+        self.prefixes = {}
+        self.tails = {}
+        self.tails2 = {}
+        for i, word in enumerate(self.lexicon):
+            self.positions.setdefault(word, []).append(i)
             if len(word) > 1:
-                start = key[0:2]
-                # print("start", start)
-                if word.startswith(start) and word != key:
-                    cohort_list.append(word)
-
-    cohorts[key] = cohort_list
+                self.prefixes.setdefault(word[0:2], []).append(i)
+                self.tails2.setdefault(word[2:], []).append(i)
+            if len(word) > 0:
+                self.tails.setdefault(word[1:], []).append(i)
+
+    # Adds a word at the end of the lexicon
+    def add(self, word):
+        i = len(self.lexicon)
+        self.lexicon.append(word)
+        self.positions.setdefault(word, []).append(i)
+        if len(word) > 1:
+            self.prefixes.setdefault(word[0:2], []).append(i)
+        if len(word) > 0:
+            self.tails.setdefault(word[1:], []).append(i)
+        if len(word) > 1:
+            self.tails2.setdefault(word[2:], []).append(i)
+
+    # Removes every occurrence of a word (its positions are left empty, so the
+    # others keep theirs)
+    def remove(self, word):
+        for i in self.positions.pop(word, []):
+            self.lexicon[i] = None
+            for table, key, minLength in ((self.prefixes, word[0:2], 2), (self.tails, word[1:], 1),
+                                          (self.tails2, word[2:], 2)):
+                if len(word) >= minLength:
+                    table[key].remove(i)
+                    if not table[key]:
+                        del table[key]
+
+    # Words whose lists of each relation can change when this word is added or
+    # removed: for cohorts the words with its first two phonemes; for rhymes (and
+    # rhymes2) the words of the same length with the same ending, its ending (one
+    # phoneme shorter), the words one phoneme longer that end with it and, for
+    # rhymes2, the words whose ending is the word without its first two phonemes.
+    # The word itself is included even when it is not in the lexicon (yet or any more)
+    # output: dict of relation name -> set of words
+    def affected(self, word):
+        cohorts = set(self.prefixes.get(word[0:2], [])) if len(word) > 1 else set()
+        rhymes = set(self.tails.get(word, []))
+        if len(word) > 0:
+            rhymes.update(self.tails.get(word[1:], []), self.positions.get(word[1:], []))
+        rhymes2 = rhymes | set(self.tails.get(word[2:], [])) if len(word) > 1 else rhymes
+        return {name: {self.lexicon[i] for i in found} | {word}
+                for name, found in (('cohorts', cohorts), ('rhymes', rhymes), ('rhymes2', rhymes2))}
+
+    # Words at some positions, in lexicon order, without the target itself (or
+    # their positions)
+    def words(self, phon, *positions, asPositions=False):
+        found = [i for i in sorted(set().union(*positions)) if self.lexicon[i] != phon]
+        return found if asPositions else [self.lexicon[i] for i in found]
+
+    # Cohorts of one word: every other word that shares its first two phonemes
+    # (single-phoneme words have no cohorts)
+    def cohorts(self, phon, asPositions=False):
+        if len(phon) < 2:
+            return []
+        return self.words(phon, self.prefixes.get(phon[0:2], []), asPositions=asPositions)
+
+    # Rhymes of one word: words of the same length that share everything after
+    # the first phoneme, the word that is exactly that remainder (one phoneme
+    # shorter), and words with one phoneme added at the onset. For a
+    # single-phoneme word the remainder is the word itself, so only the last
+    # rule finds anything
+    def rhymes(self, phon, asPositions=False):
+        added = self.tails.get(phon, [])
+        if len(phon) < 2:
+            return self.words(phon, added, asPositions=asPositions)
+        end = phon[1:]
+        return self.words(phon, self.tails.get(end, []), self.positions.get(end, []), added,
+                          asPositions=asPositions)
+
+    # Variant: every word of the same length, one shorter or one longer that ends
+    # with everything after the first phoneme (so a longer word may differ in its
+    # first two phonemes rather than add one). Single-phoneme words get the same
+    # rhymes as with rhymes()
+    def rhymes2(self, phon, asPositions=False):
+        if len(phon) < 2:
+            return self.rhymes(phon, asPositions)
+        end = phon[1:]
+        return self.words(phon, self.tails.get(end, []), self.positions.get(end, []), self.tails2.get(end, []),
+                          asPositions=asPositions)
+
+
+# Adds the cohorts and rhymes columns to a lexicon table
+# input: dataframe with a Phonology column, lexicon to search (default: the same
+#        words), whether to add the rhymes2 variant as well
+# output: the dataframe, with one list per row in 'cohorts' and 'rhymes' (and 'rhymes2')
+def rhymesCohorts(df, lexicon=None, rhymes2=False):
+    if lexicon is None:
+        lexicon = df.Phonology.tolist()
+    index = LexiconIndex(lexicon)
+    df['cohorts'] = [index.cohorts(phon) for phon in df['Phonology']]
+    df['rhymes'] = [index.rhymes(phon) for phon in df['Phonology']]
+    if rhymes2:
+        df['rhymes2'] = [index.rhymes2(phon) for phon in df['Phonology']]
+    return df
+
+
+# Lexicon edits on an existing cohorts/rhymes table, finding the lists that
+# change through the index instead of recomputing every word
+# input: LexiconIndex of the current lexicon (edited in place), phonology strings
+#        to add and to remove
+# output: dict of relation name -> words of the edited lexicon whose lists change
+def edit(index, added, removed):
+    for word in removed:
+        index.remove(word)
+    for word in added:
+        index.add(word)
+    changed = {'cohorts': set(), 'rhymes': set(), 'rhymes2': set()}
+    for word in list(removed) + list(added):
+        for name, words in index.affected(word).items():
+            changed[name].update(words)
+    return {name: words & set(index.positions) for name, words in changed.items()}
+
+
+# Updates a relation table (rhymes-cohorts.py's default output): only the rows
+# that change are recomputed, the others are copied (CSR.edited). The table's
+# vocabulary is its lexicon; removed words are dropped from it, and added words
+# that it lacks are appended
+# input: table directory, phonology strings to add and to remove, table to write
+# output: number of rows recomputed
+def updateTable(path, added, removed, outfile):
+    table = relation_table.RelationTable(path)
+    names = list(table.header['relations'])
+    if set(names) - {'cohorts', 'rhymes', 'rhymes2'}:
+        raise ValueError(path + ' has relations rhymes-cohorts.py does not make: ' + ', '.join(names))
+    vocabulary = table.words.tolist()
+    index = LexiconIndex(vocabulary)
+    removed = [word for word in dict.fromkeys(removed) if word in index.positions]
+    added = [word for word in dict.fromkeys(added) if word not in index.positions or word in removed]
+    changed = edit(index, added, removed)
+
+    # lexicon positions -> ids of the edited table (removed positions are left empty)
+    present = np.array([word is not None for word in index.lexicon])
+    ids = np.cumsum(present) - 1
+    newIds = np.where(present[:len(vocabulary)], ids[:len(vocabulary)], -1)
+    words = [word for word in index.lexicon if word is not None]
+    relations = {}
+    recomputed = 0
+    for name in names:
+        rows = {}
+        groups = {}
+        for word in changed[name]:
+            i = ids[index.positions[word][0]]
+            if name == 'cohorts' and len(word) > 1:
+                # the cohorts of a word are its prefix group without it, so each
+                # group is looked up once
+                if word[0:2] not in groups:
+                    groups[word[0:2]] = ids[sorted(index.prefixes[word[0:2]])]
+                rows[i] = groups[word[0:2]][groups[word[0:2]] != i]
+            else:
+                rows[i] = ids[getattr(index, name)(word, asPositions=True)]
+        relations[name] = table[name].edited(newIds, len(words), rows)
+        recomputed = recomputed + len(rows)
+    relation_table.write(outfile, words, relations, table.header.get('source'))
+    return recomputed
+
+
+# Updates a rhymes-cohorts dataframe (--format pickle): rows of removed words are
+# dropped, added rows appended, and the lists that change recomputed
+# input: dataframe, rows to add (dataframe with at least a Phonology column),
+#        phonology strings to remove
+# output: the dataframe, number of lists recomputed
+def updateFrame(df, addedDF, removed):
+    index = LexiconIndex(df['Phonology'].tolist())
+    changed = edit(index, addedDF['Phonology'].tolist(), removed)
+    df = pd.concat([df[~df['Phonology'].isin(removed)], addedDF], ignore_index=True)
+    recomputed = 0
+    for name in [name for name in ('cohorts', 'rhymes', 'rhymes2') if name in df]:
+        lists = df[name].tolist()
+        for row, phon in enumerate(df['Phonology']):
+            if phon in changed[name]:
+                lists[row] = getattr(index, name)(phon)
+                recomputed = recomputed + 1
+        df[name] = lists
+    return df, recomputed
+
+
+def parse():
+    parser = argparse.ArgumentParser(prog='rhymes-cohorts',
+                                     description='Finds the cohorts and rhymes of every word of a lexicon')
+    parser.add_argument('File', metavar='file', type=str, nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..',
+                                             'pseudo-lexicon', 'pseudo-lexicon.csv'),
+                        help='lexicon csv with a Phonology column (default: the pseudo-lexicon)')
+    parser.add_argument('-o', '--outfile', type=str, default=None,
+                        help='relation table or pickle to write (default ./tlex_rhymes_cohorts.rel, '
+                             'or .pickle with --format pickle)')
+    parser.add_argument('-f', '--format', choices=['table', 'pickle'], default='table',
+                        help='table: memory-mapped relation table (see relation_table.py); '
+                             'pickle: the dataframe, as earlier versions wrote it')
+    parser.add_argument('--rhymes2', action='store_true',
+                        help='also add the rhymes2 column (same, one shorter or one longer, sharing the ending)')
+    parser.add_argument('-u', '--update', type=str, metavar='TABLE',
+                        help='edit the lexicon of an existing relation table or pickle instead of building one '
+                             '(-a / -af / -rm); written to -o, by default in place. tlex.xml and tlex-code.txt are '
+                             'regenerated from the lexicon csv with implement-lex.py')
+    parser.add_argument('-a', '--add', nargs='+', default=[], metavar='PHONOLOGY', help='words to add with --update')
+    parser.add_argument('-af', '--addFile', type=str, metavar='FILENAME',
+                        help='csv of lexicon rows to add with --update (Phonology column; a pickle keeps every '
+                             'column)')
+    parser.add_argument('-rm', '--remove', nargs='+', default=[], metavar='PHONOLOGY',
+                        help='words to remove with --update')
+    return parser
+
+
+if __name__ == "__main__":
+    args = parse().parse_args()
+    if args.update:
+        addedDF = pd.DataFrame({'Phonology': args.add})
+        if args.addFile:
+            addedDF = pd.concat([addedDF, pd.read_csv(args.addFile, keep_default_na=False)], ignore_index=True)
+        start = time.perf_counter()
+        if relation_table.isTable(args.update):
+            changed = updateTable(args.update, addedDF['Phonology'].tolist(), args.remove,
+                                  args.outfile or args.update)
+        else:
+            with open(args.update, 'rb') as f:
+                df = pickle.load(f)
+            df, changed = updateFrame(df, addedDF, args.remove)
+            with open(args.outfile or args.update, 'wb') as f:
+                pickle.dump(df, f)
+        print(str(changed) + ' lists recomputed in ' + str(round(time.perf_counter() - start, 3)) + ' secs')
+        sys.exit()
 
-print('cohorts\n', cohorts)
+    pd.set_option('max_colwidth', 1000)
+    pd.set_option('display.max_columns', None)
+    pd.set_option('display.max_rows', None)
+    pd.options.display.width = 0
 
+    df = pd.read_csv(args.File, keep_default_na=False)
+    print(df)
 
-# print(rhymes)
+    lexicon = df.Phonology.tolist()
 
-for key, value in rhymes.items():
-    # print("key, val", key, value)
-    rhymes_list = []
+    # cohorts and rhymes
+    df = rhymesCohorts(df, lexicon, args.rhymes2)
 
-    for word in lexicon:
-        # print('word', word)
-        if len(key) > 1:
-            end = key[1:len(key)]
-            # print('end', end)
-            if word.endswith(end) and word != key and (len(word) == len(key) or  (len(word) == len(key) - 1)):
-                rhymes_list.append(word)
-            if (len(word) == len(key) + 1) and word[1:len(word)] == key:
-                rhymes_list.append(word)
+    print(df)
+    print(df['rhymes'])
 
-        else:
-            end = key
-            # print('end', end)
-            if word.endswith(end) and word != key and (len(word) == len(key) or  (len(word) == len(key) - 1)):
-                rhymes_list.append(word)
-            if (len(word) == len(key) + 1) and word[1:len(word)] == key:
-                    rhymes_list.append(word)
-            # print("start", start)
-            # if word.startswith(start) and word != key:
-            #     cohort_list.append(word)
-
-    rhymes[key] = rhymes_list
-
-print('rhymes\n',rhymes)
-
-
-with open('rhymes.pkl', 'wb') as f:
-    pickle.dump(rhymes,f)
-
-with open('cohorts.pkl', 'wb') as f:
-    pickle.dump(cohorts,f)
-
-#
-# for key, value in rhymes2.items():
-#     # print("key, val", key, value)
-#     rhymes_list = []
-#
-#     for word in lexicon:
-#         # print('word', word)
-#         if len(key) > 1:
-#             end = key[1:len(key)]
-#             # print('end', end)
-#             if word.endswith(end) and word != key and (len(word) == len(key) or  (len(word) == len(key) - 1) or  (len(word) == len(key) + 1)):
-#                 rhymes_list.append(word)
-#             # if (len(word) == len(key) + 1) and word[1:len(word)] == key:
-#             #     rhymes_list.append(word)
-#
-#         else:
-#             end = key
-#             # print('end', end)
-#             if word.endswith(end) and word != key and (len(word) == len(key) or  (len(word) == len(key) - 1) or  (len(word) == len(key) + 1)):
-#                 rhymes_list.append(word)
-#             # if (len(word) == len(key) + 1) and word[1:len(word)] == key:
-#             #         rhymes_list.append(word)
-#             # print("start", start)
-#             # if word.startswith(start) and word != key:
-#             #     cohort_list.append(word)
-#
-#     rhymes2[key] = rhymes_list
-#
-# print(rhymes2)
-#     # print('word', word)
-#     # print('cohorts[word]', cohorts[word])
-#     # cohorts[word].append("he")
-#     # print('cohorts[word] after append', cohorts[word])
-# print(cohorts)
-#
-# myList = [
-# 	{
-# 		'foo':12,
-# 		'bar':14
-# 	},
-# 	{
-# 		'moo':52,
-# 		'car':641
-# 	},
-# 	{
-# 		'doo':6,
-# 		'tar':84
-# 	}
-# ]
-
-# print(myList[0])
+    if args.format == 'pickle':
+        with open(args.outfile or './tlex_rhymes_cohorts.pickle', 'wb') as f:
+            pickle.dump(df, f)
+    else:
+        names = ['cohorts', 'rhymes'] + (['rhymes2'] if args.rhymes2 else [])
+        words, relations = relation_table.fromLists(lexicon, df['Phonology'].tolist(),
+                                                    {name: df[name].tolist() for name in names})
+        relation_table.write(args.outfile or './tlex_rhymes_cohorts.rel', words, relations,
+                             os.path.basename(args.File))